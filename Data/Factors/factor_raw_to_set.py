@@ -1,67 +1,41 @@
 # Getting factor data from raw source to a single file
 
-import pandas as pd
-
-# USA only
-BaB = pd.read_csv(r'Raw_data\BaB_all_countries.csv', index_col=0, usecols=['DATE', 'USA'])\
-    .rename(columns={'USA': 'BaB'})
-BaB.index = pd.to_datetime(BaB.index)
-
-SMB = pd.read_csv(r'Raw_data\SMB_all_countries.csv', index_col=0, usecols=['DATE', 'USA'])\
-    .rename(columns={'USA': 'SMB'})
-SMB.index = pd.to_datetime(SMB.index)
-
-HML = pd.read_csv(r'Raw_data\HML_all_countries.csv', index_col=0, usecols=['DATE', 'USA'])\
-    .rename(columns={'USA': 'HML'})
-HML.index = pd.to_datetime(HML.index)
-
-HML_Devil = pd.read_csv(r'Raw_data\HML_Devil_all_countries.csv', index_col=0, usecols=['DATE', 'USA'])\
-    .rename(columns={'USA': 'HML_Devil'})
-HML_Devil.index = pd.to_datetime(HML_Devil.index)
-
-UMD = pd.read_csv(r'Raw_data\UMD_all_countries.csv', index_col=0, usecols=['DATE', 'USA'])\
-    .rename(columns={'USA': 'UMD'})
-UMD.index = pd.to_datetime(UMD.index)
-
-QMJ = pd.read_csv(r'Raw_data\QMJ_all_countries.csv', index_col=0, usecols=['DATE', 'USA'])\
-    .rename(columns={'USA': 'QMJ'})
-QMJ.index = pd.to_datetime(QMJ.index)
-
-CMA = pd.read_csv(r'Raw_data\F-F_Research_Data_5_Factors_2x3_daily.CSV', index_col=0, usecols=['DATE', 'CMA'])
-CMA.index = pd.to_datetime(CMA.index, format='%Y%m%d')
-
-RMW = pd.read_csv(r'Raw_data\F-F_Research_Data_5_Factors_2x3_daily.CSV', index_col=0, usecols=['DATE', 'RMW'])
-RMW.index = pd.to_datetime(RMW.index, format='%Y%m%d')
-
-MOM = pd.read_csv(r'Raw_data\F-F_Momentum_Factor_daily.CSV', index_col=0, usecols=['DATE', 'MOM'])
-MOM.index = pd.to_datetime(MOM.index, format='%Y%m%d')
-
-Mkt_RF = pd.read_csv(r'Raw_data\F-F_Research_Data_5_Factors_2x3_daily.CSV', index_col=0, usecols=['DATE', 'Mkt-RF'])
-Mkt_RF.index = pd.to_datetime(Mkt_RF.index, format='%Y%m%d')
-
-M2USEV = pd.read_csv(r'Raw_data\US_msci_tickers.csv',index_col=0, usecols=['DATE', 'M2USEV']).pct_change()*100
-M2USEV.index = pd.to_datetime(M2USEV.index, format='%d/%m/%Y')
-
-M2USEW = pd.read_csv(r'Raw_data\US_msci_tickers.csv',index_col=0, usecols=['DATE', 'M2USEW']).pct_change()*100
-M2USEW.index = pd.to_datetime(M2USEW.index, format='%d/%m/%Y')
-
-M2US000 = pd.read_csv(r'Raw_data\US_msci_tickers.csv',index_col=0, usecols=['DATE', 'M2US000']).pct_change()*100
-M2US000.index = pd.to_datetime(M2US000.index, format='%d/%m/%Y')
-
-M2USVOE = pd.read_csv(r'Raw_data\US_msci_tickers.csv',index_col=0, usecols=['DATE', 'M2USVOE']).pct_change()*100
-M2USVOE.index = pd.to_datetime(M2USVOE.index, format='%d/%m/%Y')
-
-M5USIDY = pd.read_csv(r'Raw_data\US_msci_tickers.csv',index_col=0, usecols=['DATE', 'M5USIDY']).pct_change()*100
-M5USIDY.index = pd.to_datetime(M5USIDY.index, format='%d/%m/%Y')
-
-M2NAUSQL = pd.read_csv(r'Raw_data\US_msci_tickers.csv',index_col=0, usecols=['DATE', 'M2NAUSQL']).pct_change()*100
-M2NAUSQL.index = pd.to_datetime(M2NAUSQL.index, format='%d/%m/%Y')
-
-M05JUS0 = pd.read_csv(r'Raw_data\US_msci_tickers.csv',index_col=0, usecols=['DATE', 'M05JUS0']).pct_change()*100
-M05JUS0.index = pd.to_datetime(M05JUS0.index, format='%d/%m/%Y')
-
-
-all_factors = pd.concat([BaB, SMB, HML, HML_Devil, UMD, QMJ, CMA, RMW, MOM, Mkt_RF, M2USEV, M2USEW, M2US000, M2USVOE,
-                         M5USIDY, M2NAUSQL, M05JUS0], axis=1)
-all_factors.to_csv('all_factors.csv')
-
+import os
+import sys
+
+# paths from this file, so the script runs from any working directory
+FACTORS_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(os.path.dirname(FACTORS_DIRECTORY)))
+
+import factor_data
+import factor_ingestion
+
+RAW_DIRECTORY = os.path.join(FACTORS_DIRECTORY, 'Raw_data')
+FACTORS_FILE = os.path.join(FACTORS_DIRECTORY, 'all_factors.csv')
+
+# manifest of the raw files: each file is read once for all the factors it gives (USA only)
+SOURCES = [
+    {'file': 'BaB_all_countries.csv', 'columns': {'USA': 'BaB'}, 'date_format': '%m/%d/%Y'},
+    {'file': 'SMB_all_countries.csv', 'columns': {'USA': 'SMB'}, 'date_format': '%m/%d/%Y'},
+    {'file': 'HML_all_countries.csv', 'columns': {'USA': 'HML'}, 'date_format': '%m/%d/%Y'},
+    {'file': 'HML_Devil_all_countries.csv', 'columns': {'USA': 'HML_Devil'}, 'date_format': '%m/%d/%Y'},
+    {'file': 'UMD_all_countries.csv', 'columns': {'USA': 'UMD'}, 'date_format': '%m/%d/%Y'},
+    {'file': 'QMJ_all_countries.csv', 'columns': {'USA': 'QMJ'}, 'date_format': '%m/%d/%Y'},
+    {'file': 'F-F_Research_Data_5_Factors_2x3_daily.CSV', 'columns': {'CMA': 'CMA', 'RMW': 'RMW', 'Mkt-RF': 'Mkt-RF'},
+     'date_format': '%Y%m%d'},
+    {'file': 'F-F_Momentum_Factor_daily.CSV', 'columns': {'MOM': 'MOM'}, 'date_format': '%Y%m%d'},
+    # MSCI index levels, turned into returns
+    {'file': 'US_msci_tickers.csv', 'columns': {'M2USEV': 'M2USEV', 'M2USEW': 'M2USEW', 'M2US000': 'M2US000',
+                                                'M2USVOE': 'M2USVOE', 'M5USIDY': 'M5USIDY', 'M2NAUSQL': 'M2NAUSQL',
+                                                'M05JUS0': 'M05JUS0'},
+     'date_format': '%d/%m/%Y', 'prices': True},
+]
+
+FACTOR_ORDER = ['BaB', 'SMB', 'HML', 'HML_Devil', 'UMD', 'QMJ', 'CMA', 'RMW', 'MOM', 'Mkt-RF', 'M2USEV', 'M2USEW',
+                'M2US000', 'M2USVOE', 'M5USIDY', 'M2NAUSQL', 'M05JUS0']
+
+if __name__ == '__main__':
+    # only the raw files changed since the last run are parsed again
+    parsed = factor_ingestion.build_factor_set(SOURCES, RAW_DIRECTORY, factor_data.factor_set_directory(FACTORS_FILE),
+                                               csv_path=FACTORS_FILE, factor_order=FACTOR_ORDER)
+    print('Parsed: {}'.format(parsed))
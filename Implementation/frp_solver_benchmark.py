@@ -0,0 +1,65 @@
+import os
+os.chdir('../')
+
+import datetime as dt
+import time
+import io
+import contextlib
+import numpy as np
+import pandas as pd
+from dateutil.relativedelta import relativedelta
+
+# ############### Import my scripts ###############
+import stock_data
+import factor_data
+import factor_risk_parity as frp
+from rolling_estimators import RollingCovariance, RollingLoadings
+
+
+# ############### Data gathering ###############
+start_date = dt.date(2004, 12, 31)
+end_date = dt.date(2019, 12, 31)
+
+# whole universe of the prices file, removing NaN columns as in the other scripts
+tickers = stock_data.get_price_store().tickers
+p_tickers = stock_data.get_prices(tickers, start_date - dt.timedelta(days=365*4),
+                                  start_date - dt.timedelta(days=365*4) + dt.timedelta(days=+5))
+nan_cols = [i for i in p_tickers.columns if p_tickers[i].isnull().any()]
+tickers = [eq for eq in tickers if eq not in nan_cols]
+
+factor_tickers = ['SMB', 'MOM', 'CMA', 'BaB']
+factor_structure = [1, 1, 1, 1]
+
+
+# ############### Levenberg-Marquardt vs SLSQP on the same rebalancing dates ###############
+def objective(x, risk_model):
+    return np.sum((risk_model.risk_contributions(x) / risk_model.volatility(x) - 1 / len(factor_tickers)) ** 2)
+
+
+rows = []
+rolling_covariance = RollingCovariance()
+rolling_loadings = RollingLoadings()
+for t in pd.date_range(start_date, end_date, freq='BM'):
+    stocks = stock_data.get_daily_returns(tickers, t + relativedelta(months=-12), t)[1:]
+    factors = factor_data.get_factors(factor_tickers, stocks.index[0], stocks.index[-1])
+    loadings_matrix = frp.get_loading_matrix(stocks, factors, rolling_loadings)
+    sigma, risk_model = frp.get_risk_model(stocks, factors, loadings_matrix, 'sample', rolling_covariance)
+
+    row = {'Date': t}
+    for solver in ['slsqp', 'lm']:
+        with contextlib.redirect_stdout(io.StringIO()):
+            t0 = time.perf_counter()
+            x = frp.weights_factor_risk_parity(stocks, factor_structure, loadings_matrix, sigma, None, risk_model,
+                                               solver)
+            row[solver + ' time (s)'] = time.perf_counter() - t0
+        row[solver + ' objective'] = objective(x, risk_model)
+    x, info = frp.solve_factor_risk_parity(risk_model, np.ones(len(tickers)) / len(tickers))
+    row['lm iterations'] = info['n_iter']
+    row['lm fallback'] = not (info['converged'] and info['feasible'])
+    rows.append(row)
+
+benchmark = pd.DataFrame(rows).set_index('Date')
+benchmark.to_csv(r'Implementation\frp_solver_benchmark.csv')
+print(benchmark.describe())
+print('Total time SLSQP: {:.1f}s, Levenberg-Marquardt: {:.1f}s'.format(benchmark['slsqp time (s)'].sum(),
+                                                          benchmark['lm time (s)'].sum()))
@@ -78,8 +78,8 @@ p_tickers = stock_data.get_prices(tickers, start_date - dt.timedelta(days=365*4)
 nan_cols = [i for i in p_tickers.columns if p_tickers[i].isnull().any()]
 tickers = [eq for eq in tickers if eq not in nan_cols]
 
-# Factor Risk Parity 4 intersections:
-factor_tickers = ['SMB', 'MOM', 'CMA', 'HML_Devil', 'BaB', 'RMW', 'QMJ']
+# Factor Risk Parity 4 intersections (composite factors of factor_data.COMPOSITE_FACTORS):
+factor_tickers = ['SMB', 'MOM', 'CMA_HML_Devil', 'BaB_RMW_QMJ']
 
 frp_portfolio_weights = frp.portfolio_weights_factor_risk_parity_intersection(tickers, factor_tickers, start_date, end_date, 'BM')
 frp_portfolio_weights.to_csv(r'Implementation\frp_x_intersection.csv')
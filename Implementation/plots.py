@@ -5,6 +5,7 @@ import seaborn as sns
 import matplotlib.pyplot as plt
 import datetime as dt
 import backtest_functions as bfunc
+import rolling_analytics as ra
 
 
 sns.set(style="white")
@@ -99,8 +100,8 @@ plt.close('all')
 frp_daily = pd.read_csv('Implementation/frp_daily_4f_025.csv', index_col='Date')
 
 import numpy as np
-sp500['Volatility'] = sp500['Returns'].rolling(window=151).std() * np.sqrt(252)
-vol_frp = frp_daily.rolling(window=151).std() * np.sqrt(252)
+sp500['Volatility'] = ra.rolling_volatility(sp500['Returns'], window=151)
+vol_frp = ra.rolling_volatility(frp_daily, window=151)
 
 sns.lineplot(y=vol_frp.values, x=vol_frp.index, data=vol_frp.values, ci=None, estimator=None, label='6-months volatility',
              color='red')
@@ -116,9 +117,7 @@ plt.close()
 
 
 frp_daily.index = pd.to_datetime(frp_daily.index)
-frp_cum_prod = (frp_daily + 1).cumprod()
-current_max = np.maximum.accumulate(frp_cum_prod)
-underwater = -100 * ((current_max - frp_cum_prod) / current_max)
+underwater = 100 * ra.rolling_drawdown(frp_daily)
 g = underwater.plot(kind='area', color='tomato', alpha=0.7)
 plt.gca().set_yticklabels(['{:.0f}%'.format(x) for x in plt.gca().get_yticks()])
 plt.grid(True)
@@ -0,0 +1,128 @@
+# append-only checkpoint of the rebalancing dates completed by a back test, to resume or extend it
+
+import os
+import json
+import pickle
+import numpy as np
+import pandas as pd
+import data_cache
+
+
+class BacktestCheckpoint:
+    """ Append-only text file of the weights of the completed rebalancing dates.
+
+    The first line records the tickers and the settings of the back test, every following line holds one date and
+    its weights (which are also the warm start of the next date). Each line is flushed to disk as soon as the date
+    is solved, so an interrupted back test loses at most the date being solved: a rerun reads the completed dates,
+    skips them and continues from the last weights, and a rerun with a later end date only solves the new dates.
+    The state kept between dates (rolling estimators, n x n running sums) is saved next to the file once every
+    state_interval dates; a resumed back test solves again the dates after the saved state, so it carries on with
+    the same running sums as an uninterrupted one.
+    """
+
+    def __init__(self, path, tickers, settings=None, state_interval=12):
+        """
+        :param path: path of the checkpoint file
+        :param tickers: tickers of the weights
+        :param settings: dict of the settings of the back test (factors, solver, ...); a file written with other
+            tickers or settings is refused
+        :param state_interval: number of dates appended with a state between two saves of the state
+        """
+        self.path = path
+        self.tickers = [str(ticker) for ticker in tickers]
+        self.settings = {} if settings is None else json.loads(json.dumps(settings))
+        self.state_interval = state_interval
+        self._unsaved_dates = 0
+
+    def _header(self):
+        return json.dumps({'tickers': self.tickers, 'settings': self.settings})
+
+    def load(self):
+        """ Reads the completed dates, dropping a last line left incomplete by an interruption
+
+        :return: dict of rebalancing date to weights vector, in the order they were written
+        """
+        if not os.path.exists(self.path):
+            return {}
+
+        completed = {}
+        with open(self.path, 'rb') as f:
+            header = f.readline()
+            if not header.endswith(b'\n'):
+                good_size = 0
+            else:
+                if json.loads(header.decode()) != json.loads(self._header()):
+                    raise ValueError('Checkpoint file {} was written for other tickers or settings'.format(self.path))
+                good_size = f.tell()
+                for line in f:
+                    fields = line.decode(errors='replace').rstrip('\n').split(',')
+                    if not line.endswith(b'\n') or len(fields) != len(self.tickers) + 1:
+                        break
+                    try:
+                        completed[pd.Timestamp(fields[0])] = np.array(fields[1:], dtype=np.float64)
+                    except ValueError:
+                        break
+                    good_size = f.tell()
+
+        if good_size != os.path.getsize(self.path):
+            # remove the torn record so the next records are appended after a complete line
+            with open(self.path, 'r+b') as f:
+                f.truncate(good_size)
+
+        return completed
+
+    def append(self, date, weights, state=None):
+        """ Records the weights of a completed rebalancing date
+
+        :param date: rebalancing date
+        :param weights: asset weights vector
+        :param state: optional dict kept between consecutive dates, as it is after solving the date; saved once
+            every state_interval dates
+        """
+        new_file = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+        with open(self.path, 'a') as f:
+            if new_file:
+                f.write(self._header() + '\n')
+            f.write(pd.Timestamp(date).strftime('%Y-%m-%d') + ',' +
+                    ','.join(repr(w) for w in np.asarray(weights, dtype=np.float64).tolist()) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        if state is not None:
+            self._unsaved_dates += 1
+            if self._unsaved_dates >= self.state_interval:
+                self.save_state(date, state)
+
+    def _state_path(self):
+        return self.path + '.state'
+
+    def save_state(self, date, state):
+        """ Saves the state kept between dates, as it is after solving the given date
+
+        :param date: last rebalancing date solved
+        :param state: dict kept between consecutive dates
+        """
+        saved = {'date': pd.Timestamp(date), 'state': state}
+        data_cache.write_atomic(self._state_path(), lambda f: pickle.dump(saved, f))
+        self._unsaved_dates = 0
+
+    def flush_state(self, date, state):
+        """ Saves the state when dates were appended since the last save (at the end of a back test)
+
+        :param date: last rebalancing date solved
+        :param state: dict kept between consecutive dates
+        """
+        if self._unsaved_dates:
+            self.save_state(date, state)
+
+    def load_state(self):
+        """ Last saved state
+
+        :return: rebalancing date after which the state was saved (None when no state was saved) and dict kept
+            between consecutive dates
+        """
+        try:
+            with open(self._state_path(), 'rb') as f:
+                saved = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return None, {}
+        return saved.get('date'), saved.get('state', {})
@@ -1,25 +1,167 @@
 # functions to use after obtaining portfolio weights over the back-test period
 
 import stock_data
+import numpy as np
 import pandas as pd
 
 
-def daily_returns_of_portfolio(weights_portfolio):
+def _backtest_returns(tickers, rebalance_dates):
+    """ Daily returns of the stocks over a back test, from the day after the first rebalancing date to the last one
+
+    :param tickers: List of tickers of the stocks
+    :param rebalance_dates: DatetimeIndex of the rebalancing dates
+    :return: DatetimeIndex of the days, 2-D array of returns (missing returns as 0) and, for each rebalancing date,
+        the position of the first day its weights are held (the weights of rebalancing date k are held on the days
+        bounds[k]:bounds[k + 1])
+    """
+    store = stock_data.get_price_store()
+    first = np.searchsorted(store.return_dates, stock_data._to_datetime64(rebalance_dates[0]), side='right')
+    last = np.searchsorted(store.return_dates, stock_data._to_datetime64(rebalance_dates[-1]), side='right')
+    days = pd.DatetimeIndex(store.return_dates[first:last], name=store.index_name)
+    returns = np.nan_to_num(np.asarray(store.returns[first:last][:, store.column_indices(tickers)]))
+    bounds = np.searchsorted(days.values, rebalance_dates.values, side='right')
+
+    return days, returns, bounds
+
+
+def _open_days(returns, weights):
+    """ Open market days of a holding period: days where a stock held in the period has a non zero return, read
+    from the stock returns so the rounding of the portfolio returns can not turn a holiday into a trading day
+
+    :param returns: 2-D array of the stock returns of the days of the period (days x stocks)
+    :param weights: 2-D array of the weights set at the rebalancing date (stocks x portfolios)
+    :return: boolean array, one value per day
+    """
+    return (returns[:, (weights != 0).any(axis=1)] != 0).any(axis=1)
+
+
+def _drift_period(returns, weights):
+    """ Holding period of weights drifting with the stock returns, the part not invested in stocks held in cash
+
+    :param returns: 2-D array of the stock returns of the days of the period (days x stocks)
+    :param weights: 2-D array of the weights set at the rebalancing date (stocks x portfolios)
+    :return: daily returns of the portfolios (days x portfolios), growth of each stock since the rebalancing date
+        and value of each portfolio relative to it (both with a first row for the rebalancing date)
+    """
+    growth = np.vstack([np.ones(returns.shape[1]), np.cumprod(1 + returns, axis=0)])
+    value = np.matmul(growth, weights) + (1 - weights.sum(axis=0))
+
+    return value[1:] / value[:-1] - 1, growth, value
+
+
+def portfolio_backtest(weights_portfolio, drift=False):
+    """ Back tests a portfolio rebalanced to the given weights, on float arrays of the compiled returns panel
+
+    The weights of a rebalancing date are held from the next business day. With drift, the holdings then move with
+    the stock returns until the next rebalancing (w_i becomes w_i (1 + r_i) / (1 + w'r) each day, the part of the
+    portfolio not invested in stocks being held in cash); without drift the weights are kept constant.
+
+    :param weights_portfolio: The weights of the portfolio's equities over the back-test period
+    :param drift: let the weights drift with the returns between rebalancing dates
+    :return: daily returns of the portfolio, turnover at each rebalancing date (sum of absolute weight changes
+        from the drifted weights) and DataFrame of the daily gross and net leverage of the weights held
+    """
+    rebalance_dates = pd.DatetimeIndex(weights_portfolio.index)
+    weights = np.nan_to_num(np.asarray(weights_portfolio.values, dtype=np.float64))
+    days, returns, bounds = _backtest_returns(list(weights_portfolio.columns), rebalance_dates)
+    n_days, n_stocks = returns.shape
+    daily_returns = np.zeros(n_days)
+    held = np.zeros((n_days, n_stocks))
+    turnover = np.zeros(len(rebalance_dates))
+    previous = np.zeros(n_stocks)
+    open_days = np.zeros(n_days, dtype=bool)
+    for k in range(len(rebalance_dates)):
+        turnover[k] = np.abs(weights[k] - previous).sum()
+        if k + 1 == len(rebalance_dates):
+            break
+        period = slice(bounds[k], bounds[k + 1])
+        open_days[period] = _open_days(returns[period], weights[k][:, None])
+        if not drift:
+            held[period] = weights[k]
+            daily_returns[period] = np.matmul(returns[period], weights[k])
+            previous = weights[k]
+            continue
+        period_returns, growth, value = _drift_period(returns[period], weights[k][:, None])
+        daily_returns[period] = period_returns[:, 0]
+        # value of the holdings relative to the rebalancing date, as weights of the portfolio (cash included)
+        holdings = weights[k] * growth
+        held[period] = holdings[:-1] / value[:-1]
+        previous = holdings[-1] / value[-1, 0]
+
+    # only open market days are passed
+    daily_returns = pd.Series(daily_returns[open_days], index=days[open_days], name='Returns')
+    turnover = pd.Series(turnover, index=weights_portfolio.index, name='Turnover')
+    leverage = pd.DataFrame({'Gross': np.abs(held[open_days]).sum(axis=1), 'Net': held[open_days].sum(axis=1)},
+                            index=days[open_days])
+
+    return daily_returns, turnover, leverage
+
+
+def daily_returns_of_portfolio(weights_portfolio, drift=False):
     """ Calculates the daily returns of a portfolio
 
     :param weights_portfolio: The weights of the portfolio's equities over the back-test period
+    :param drift: let the weights drift with the returns between rebalancing dates (constant weights if False)
     :return: daily returns of the portfolio
     """
-    tickers = weights_portfolio.columns
-    start_date = weights_portfolio.index[0]
-    end_date = weights_portfolio.index[-1]
-    stock_returns = stock_data.get_daily_returns(tickers, start_date, end_date)[1:]
+    return portfolio_backtest(weights_portfolio, drift)[0]
 
-    daily_returns = pd.Series(
-        (stock_returns * (weights_portfolio.asfreq('B').ffill().shift(1))).sum(1),
-        index=pd.to_datetime(stock_returns.index), name='Returns')
-    # only open market days are passed
-    return daily_returns[daily_returns != 0]
+
+def batched_daily_returns(weights_tensor, rebalance_dates, tickers, names=None, drift=False):
+    """ Daily returns of several portfolios over the same universe and rebalancing dates
+
+    The stock returns are sliced once and each holding period is a single matrix product shared by all portfolios:
+    returns (days x stocks) times weights (stocks x portfolios) for constant weights, or cumulated returns times
+    weights for drifting weights (the same holding period as portfolio_backtest).
+
+    :param weights_tensor: 3-D array of weights (portfolios x rebalancing dates x stocks)
+    :param rebalance_dates: rebalancing dates
+    :param tickers: List of tickers of the stocks
+    :param names: names of the portfolios (columns of the result), 0..n-1 if None
+    :param drift: let the weights drift with the returns between rebalancing dates (see portfolio_backtest)
+    :return: DataFrame of daily returns, one column per portfolio
+    """
+    weights = np.nan_to_num(np.asarray(weights_tensor, dtype=np.float64))
+    rebalance_dates = pd.DatetimeIndex(rebalance_dates)
+    if weights.ndim != 3 or weights.shape[1:] != (len(rebalance_dates), len(tickers)):
+        raise ValueError('weights_tensor must have shape (portfolios, rebalancing dates, stocks)')
+    days, returns, bounds = _backtest_returns(list(tickers), rebalance_dates)
+
+    daily_returns = np.zeros((len(days), weights.shape[0]))
+    open_days = np.zeros(len(days), dtype=bool)
+    for k in range(len(rebalance_dates) - 1):
+        period = slice(bounds[k], bounds[k + 1])
+        period_weights = weights[:, k, :].T
+        open_days[period] = _open_days(returns[period], period_weights)
+        if not drift:
+            daily_returns[period] = np.matmul(returns[period], period_weights)
+            continue
+        daily_returns[period] = _drift_period(returns[period], period_weights)[0]
+
+    # only open market days are passed (days where a stock held by some portfolio moved)
+
+    return pd.DataFrame(daily_returns[open_days], index=days[open_days],
+                        columns=range(weights.shape[0]) if names is None else list(names))
+
+
+def portfolios_daily_returns(portfolio_weights, drift=False):
+    """ Daily returns of several portfolios, e.g. the variants of a strategy, in one pass
+
+    :param portfolio_weights: dict of portfolio name to DataFrame of weights, all with the same rebalancing dates;
+        stocks missing from a portfolio have weight 0
+    :param drift: let the weights drift with the returns between rebalancing dates (see portfolio_backtest)
+    :return: DataFrame of daily returns, one column per portfolio
+    """
+    names = list(portfolio_weights)
+    rebalance_dates = pd.DatetimeIndex(portfolio_weights[names[0]].index)
+    tickers = list(dict.fromkeys(ticker for name in names for ticker in portfolio_weights[name].columns))
+    for name in names:
+        if not pd.DatetimeIndex(portfolio_weights[name].index).equals(rebalance_dates):
+            raise ValueError('The rebalancing dates of {} and {} are not the same'.format(names[0], name))
+    weights_tensor = np.stack([portfolio_weights[name].reindex(columns=tickers).values.astype(np.float64)
+                               for name in names])
+
+    return batched_daily_returns(weights_tensor, rebalance_dates, tickers, names, drift)
 
 
 def cumulative_returns(returns):
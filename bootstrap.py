@@ -0,0 +1,150 @@
+# bootstrap confidence intervals of performance measures, resampling blocks of daily returns
+
+import os
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+
+MEASURES = ['Sharpe Ratio', 'CAGR', 'Max Drawdown', 'Expected Shortfall']
+
+
+def bootstrap_indices(n_days, n_paths, block_length, method='stationary', rng=None):
+    """ Row indices of bootstrap paths made of blocks of consecutive days (wrapping around the end of the series)
+
+    :param n_days: number of days of the series
+    :param n_paths: number of paths
+    :param block_length: length of the blocks ('block') or mean length of the blocks ('stationary')
+    :param method: 'stationary' (Politis-Romano, geometric block lengths) or 'block' (circular blocks of fixed length)
+    :param rng: numpy Generator
+    :return: 2-D array (paths x days) of row indices
+    """
+    rng = np.random.default_rng() if rng is None else rng
+    days = np.arange(n_days)
+    if method == 'stationary':
+        new_block = rng.random((n_paths, n_days)) < 1 / block_length
+        new_block[:, 0] = True
+    elif method == 'block':
+        new_block = np.broadcast_to(days % block_length == 0, (n_paths, n_days))
+    else:
+        raise ValueError("method must be 'stationary' or 'block'")
+
+    # each day continues the block started on the last new block day
+    block_start = np.maximum.accumulate(np.where(new_block, days, 0), axis=1)
+    starts = rng.integers(0, n_days, (n_paths, n_days))
+    return (np.take_along_axis(starts, block_start, axis=1) + days - block_start) % n_days
+
+
+def path_measures(paths, probability=0.05, annualization=252):
+    """ Sharpe ratio, CAGR, maximum drawdown and expected shortfall of every path, as in performance_measures
+
+    :param paths: array of daily returns with the days on axis 1 (paths x days or paths x days x portfolios)
+    :param probability: probability of the expected shortfall
+    :param annualization: number of return periods in a year
+    :return: dict of measure name to array of the measure of each path
+    """
+    n_days = paths.shape[1]
+    std = paths.std(axis=1, ddof=1)
+    log_growth = np.log1p(paths).sum(axis=1)
+
+    wealth = np.cumprod(1 + paths, axis=1)
+    peak = np.maximum(np.maximum.accumulate(wealth, axis=1), 1)
+    max_drawdown = np.minimum((wealth / peak - 1).min(axis=1), 0)
+
+    cutoff = int((n_days - 1) * probability)
+    tail = np.partition(paths, cutoff, axis=1)[:, :cutoff + 1]
+
+    return {'Sharpe Ratio': paths.mean(axis=1) / std * np.sqrt(annualization),
+            'CAGR': np.expm1(log_growth * annualization / n_days),
+            'Max Drawdown': max_drawdown,
+            'Expected Shortfall': tail.mean(axis=1)}
+
+
+def _bootstrap_chunk(returns, n_paths, block_length, method, seed, probability, annualization):
+    rng = np.random.default_rng(seed)
+    indices = bootstrap_indices(returns.shape[0], n_paths, block_length, method, rng)
+    return path_measures(returns[indices], probability, annualization)
+
+
+def bootstrap_distribution(portfolios_daily_returns, n_paths=10000, block_length=20, method='stationary',
+                           probability=0.05, n_jobs=1, chunk_size=250, seed=None, annualization=252):
+    """ Bootstrap distribution of the measures of several portfolios.
+
+    All portfolios are resampled on the same days, so the distribution of the difference of a measure between two
+    portfolios is the difference of their columns. Paths are drawn in chunks, each chunk being one array
+    (paths x days x portfolios) evaluated at once; with n_jobs above 1 the chunks run on a process pool. Each chunk
+    has its own seed spawned from seed, so results do not depend on n_jobs.
+
+    :param portfolios_daily_returns: DataFrame of daily returns, one column per portfolio (days with a missing
+        return are dropped)
+    :param n_paths: number of bootstrap paths
+    :param block_length: length (mean length for 'stationary') of the resampled blocks of days
+    :param method: 'stationary' or 'block', see bootstrap_indices
+    :param probability: probability of the expected shortfall
+    :param n_jobs: number of processes (os.cpu_count() if None)
+    :param chunk_size: number of paths of each chunk
+    :param seed: seed of the random generator
+    :param annualization: number of return periods in a year
+    :return: dict of measure name to DataFrame (paths x portfolios)
+    """
+    returns = portfolios_daily_returns.dropna()
+    values = np.ascontiguousarray(returns.values, dtype=np.float64)
+    chunks = [min(chunk_size, n_paths - start) for start in range(0, n_paths, chunk_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(chunks))
+    args = [(values, size, block_length, method, chunk_seed, probability, annualization)
+            for size, chunk_seed in zip(chunks, seeds)]
+
+    if n_jobs == 1:
+        results = [_bootstrap_chunk(*arg) for arg in args]
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs or os.cpu_count()) as executor:
+            results = list(executor.map(_bootstrap_chunk, *zip(*args)))
+
+    return {measure: pd.DataFrame(np.concatenate([result[measure] for result in results]), columns=returns.columns)
+            for measure in MEASURES}
+
+
+def bootstrap_confidence_intervals(portfolios_daily_returns, n_paths=10000, block_length=20, method='stationary',
+                                   confidence=0.95, baseline=None, probability=0.05, n_jobs=1, chunk_size=250,
+                                   seed=None, annualization=252):
+    """ Percentile bootstrap confidence intervals of the Sharpe ratio, CAGR, maximum drawdown and expected shortfall
+
+    :param portfolios_daily_returns: DataFrame of daily returns, one column per portfolio
+    :param n_paths: number of bootstrap paths
+    :param block_length: length (mean length for 'stationary') of the resampled blocks of days
+    :param method: 'stationary' or 'block', see bootstrap_indices
+    :param confidence: confidence level of the intervals
+    :param baseline: optional name of a portfolio, the intervals of the difference of each other portfolio's
+        measures with the baseline's are added (an interval excluding 0 is a significant difference)
+    :param probability: probability of the expected shortfall
+    :param n_jobs: number of processes (os.cpu_count() if None)
+    :param chunk_size: number of paths of each chunk
+    :param seed: seed of the random generator
+    :param annualization: number of return periods in a year
+    :return: DataFrame with the estimate, the bounds and the standard error of each (portfolio, measure)
+    """
+    returns = portfolios_daily_returns.dropna()
+    distribution = bootstrap_distribution(returns, n_paths, block_length, method, probability, n_jobs, chunk_size,
+                                          seed, annualization)
+    estimates = path_measures(returns.values[None], probability, annualization)
+    estimates = {measure: pd.Series(estimates[measure][0], index=returns.columns) for measure in MEASURES}
+    if baseline is not None:
+        for measure in MEASURES:
+            others = [column for column in returns.columns if column != baseline]
+            names = ['{} - {}'.format(column, baseline) for column in others]
+            distribution[measure] = pd.concat([distribution[measure], pd.DataFrame(
+                distribution[measure][others].values - distribution[measure][[baseline]].values, columns=names)],
+                axis=1)
+            estimates[measure] = pd.concat([estimates[measure], pd.Series(
+                estimates[measure][others].values - estimates[measure][baseline], index=names)])
+
+    alpha = (1 - confidence) / 2
+    bounds = {measure: np.nanpercentile(distribution[measure].values, [100 * alpha, 100 * (1 - alpha)], axis=0)
+              for measure in MEASURES}
+    rows = {}
+    for i, portfolio in enumerate(distribution[MEASURES[0]].columns):
+        for measure in MEASURES:
+            rows[(portfolio, measure)] = {'Estimate': estimates[measure][portfolio],
+                                          'Lower': bounds[measure][0, i], 'Upper': bounds[measure][1, i],
+                                          'Std Error': np.nanstd(distribution[measure].values[:, i], ddof=1)}
+
+    return pd.DataFrame.from_dict(rows, orient='index')
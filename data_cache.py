@@ -0,0 +1,119 @@
+# compiled binary forms of the csv data files, shared read-only between processes through memory mapping
+
+import os
+import zipfile
+import hashlib
+import numpy as np
+
+INDEX_FILE = 'index.npz'
+
+
+def cache_directory(source_path):
+    """ Directory holding the compiled form of a source file (next to the source file)
+
+    :param source_path: path of the source csv file
+    :return: path of the cache directory
+    """
+    return os.path.splitext(source_path)[0] + '_cache'
+
+
+def file_hash(file_path):
+    """ SHA-1 of a file's contents
+
+    :param file_path: path of the file
+    :return: hexadecimal digest
+    """
+    sha1 = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(chunk)
+
+    return sha1.hexdigest()
+
+
+def write_atomic(path, write):
+    """ Writes a file through a temporary file renamed over it, so readers never see a partly written file
+
+    :param path: path of the file
+    :param write: function writing the contents to the open binary file it receives
+    """
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        write(f)
+    os.replace(tmp_path, path)
+
+
+def read_index(cache_dir):
+    """ Index of labels of a compiled directory
+
+    :param cache_dir: directory holding the index file
+    :return: dict of index arrays, None when the index is missing or cannot be read
+    """
+    try:
+        with np.load(os.path.join(cache_dir, INDEX_FILE), allow_pickle=False) as index:
+            return {key: index[key] for key in index.files}
+    except (OSError, ValueError, EOFError, zipfile.BadZipFile):
+        return None
+
+
+def write_index(cache_dir, index):
+    """ Writes the index of labels of a compiled directory (atomically)
+
+    :param cache_dir: directory holding the index file
+    :param index: dict of index arrays
+    """
+    write_atomic(os.path.join(cache_dir, INDEX_FILE), lambda f: np.savez(f, **index))
+
+
+def _source_is_current(source_path, index):
+    """ Checks the compiled form against the source file, first by mtime and then by content hash """
+    if index is None or 'source_mtime' not in index or 'source_hash' not in index:
+        return False
+    mtime = os.path.getmtime(source_path)
+    if float(index['source_mtime']) == mtime:
+        return True
+    if str(index['source_hash']) != file_hash(source_path):
+        return False
+    # file touched but unchanged, refresh the recorded mtime so the hash is not computed again
+    index['source_mtime'] = np.array(mtime)
+    try:
+        write_index(cache_directory(source_path), index)
+    except OSError:
+        pass
+    return True
+
+
+def compiled_panels(source_path, build, panel_names):
+    """ Loads the compiled panels of a source file, (re)building them when the source file changed
+
+    The panels are stored as .npy files with a sidecar index of labels (dates, tickers, ...) and are opened as
+    read-only memory maps, so several processes reading the same data share the pages instead of each holding
+    its own parsed copy.
+
+    :param source_path: path of the source csv file
+    :param build: function receiving source_path and returning a dict of index arrays and a dict of 2-D panels
+    :param panel_names: names of the panels returned by build
+    :return: dict of index arrays and dict of read-only memory mapped panels
+    """
+    cache_dir = cache_directory(source_path)
+    index = read_index(cache_dir)
+
+    if not _source_is_current(source_path, index) or \
+            not all(os.path.exists(os.path.join(cache_dir, name + '.npy')) for name in panel_names):
+        index, panels = build(source_path)
+        index = dict(index, source_mtime=np.array(os.path.getmtime(source_path)),
+                     source_hash=np.array(file_hash(source_path)))
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            for name in panel_names:
+                panel = np.ascontiguousarray(panels[name])
+                write_atomic(os.path.join(cache_dir, name + '.npy'), lambda f: np.save(f, panel))
+            # index written last, it marks the panels as complete
+            write_index(cache_dir, index)
+        except OSError:
+            # cache not writable (or panels mapped by another process on Windows): use the built copy
+            return index, panels
+
+    panels = {name: np.load(os.path.join(cache_dir, name + '.npy'), mmap_mode='r') for name in panel_names}
+
+    return index, panels
@@ -1,6 +1,7 @@
 import stock_data
 import numpy as np
 import pandas as pd
+import parallel_backtest
 from alive_progress import alive_bar
 from alive_progress import config_handler
 config_handler.set_global(force_tty=True)
@@ -14,9 +15,24 @@ def ew_weights(stock_tickers, date):
     return x
 
 
-def portfolio_weights_ew(tickers, start_date, end_date, portfolio_rebalance_period):
+def ew_on_date(t, x0, state, tickers):
+    """ Equal weights of one rebalancing date (x0 and state are not used) """
+    return ew_weights(tickers, t)
+
+
+def ew_strategy(window, x0):
+    """ Equal weights of a rebalance_pipeline.RebalanceWindow (x0 is not used) """
+    n_stocks = window.stocks.shape[1]
+    return np.ones(n_stocks) / n_stocks
+
+
+def portfolio_weights_ew(tickers, start_date, end_date, portfolio_rebalance_period, n_jobs=1):
     business_days_end_months = pd.date_range(start_date, end_date, freq=portfolio_rebalance_period)
-    portfolio_weights = pd.DataFrame(index=business_days_end_months, columns=tickers)
+    if n_jobs != 1:
+        return parallel_backtest.run_rebalance_dates(ew_on_date, business_days_end_months, tickers, (tickers,),
+                                                     n_jobs)
+
+    portfolio_weights = pd.DataFrame(index=business_days_end_months, columns=tickers, dtype=np.float64)
 
     with alive_bar(len(business_days_end_months)) as bar:
         for t in business_days_end_months:
@@ -24,4 +40,3 @@ def portfolio_weights_ew(tickers, start_date, end_date, portfolio_rebalance_peri
             bar()
 
     return portfolio_weights
-
@@ -1,6 +1,227 @@
 # functions to get data from factors
 
+import os
+import hashlib
+import numpy as np
 import pandas as pd
+import data_cache
+import factor_ingestion
+
+FACTORS_FILE = r'Data\Factors\all_factors.csv'
+
+# composite factors: weights of the base factors of each composite, available by name as any other factor
+COMPOSITE_FACTORS = {
+    # intersection of the value and investment cluster
+    'CMA_HML_Devil': {'CMA': 0.5, 'HML_Devil': 0.5},
+    # intersection of the low risk and quality cluster
+    'BaB_RMW_QMJ': {'BaB': 0.5, 'RMW': 0.25, 'QMJ': 0.25},
+}
+
+
+class FactorStore:
+    """ Factor returns held in memory as a dense date x factor matrix, already forward filled and scaled from
+    percentages to returns
+    """
+
+    def __init__(self, dates, factors, values, index_name=None, source_hash=None):
+        """
+        :param dates: sorted array of dates (datetime64)
+        :param factors: list of factor names, one per column of values
+        :param values: 2-D array of factor returns with shape (len(dates), len(factors))
+        :param index_name: name given to the date index of the returned DataFrames
+        :param source_hash: content hash of the source data, identifies the data (see risk_model_cache)
+        """
+        self.dates = np.asarray(dates, dtype='datetime64[ns]')
+        self.factors = list(factors)
+        self.columns = {f: i for i, f in enumerate(self.factors)}
+        self.values = values
+        self.index_name = index_name
+        self.source_hash = source_hash
+        self.composite_values = np.empty((len(self.dates), 0))
+        self.composites = {}
+
+    def add_composites(self, definitions):
+        """ Adds composite factors, weighted sums of base factors computed over the whole history with one matrix
+        product. A composite is missing on the dates where one of its base factors is missing. A composite already
+        in the store with other weights is computed again with the new ones.
+
+        :param definitions: dict of composite name to dict of base factor name to weight,
+            e.g. {'CMA_HML_Devil': {'CMA': 0.5, 'HML_Devil': 0.5}}
+        """
+        n_bases = self.values.shape[1]
+        redefined_bases = [name for name in definitions if name in self.columns and self.columns[name] < n_bases]
+        if redefined_bases:
+            raise ValueError('Base factors can not be redefined as composites: {}'.format(redefined_bases))
+        names = [name for name in definitions if self.composites.get(name) != dict(definitions[name])]
+        if not names:
+            return
+        bases = list(dict.fromkeys(base for name in names for base in definitions[name]))
+        unknown = [base for base in bases if base not in self.columns or self.columns[base] >= n_bases]
+        if unknown:
+            raise ValueError('Composite factors must be defined on base factors, unknown: {}'.format(unknown))
+
+        weights = np.zeros((len(bases), len(names)))
+        for j, name in enumerate(names):
+            for base, weight in definitions[name].items():
+                weights[bases.index(base), j] = weight
+        base_values = self.values[:, [self.columns[base] for base in bases]]
+        missing = np.isnan(base_values)
+        composites = np.matmul(np.where(missing, 0, base_values), weights)
+        composites[np.matmul(missing, weights != 0)] = np.nan
+
+        new_names = [name for name in names if name not in self.columns]
+        for name in new_names:
+            self.columns[name] = len(self.factors)
+            self.factors.append(name)
+        composite_values = np.hstack([self.composite_values, np.empty((len(self.dates), len(new_names)))])
+        composite_values[:, [self.columns[name] - n_bases for name in names]] = composites
+        self.composite_values = composite_values
+        for name in names:
+            self.composites[name] = dict(definitions[name])
+
+    @classmethod
+    def from_set(cls, set_directory, csv_hash=''):
+        """ Builds the store from the factor set written by factor_ingestion.build_factor_set, whose panel is memory
+        mapped as is
+
+        :param set_directory: directory of the factor set
+        :param csv_hash: content hash of the factors csv file, the set is only used when it was built with this
+            file ('' when there is no csv file)
+        :return: FactorStore, None when the set is missing, incomplete or built with another csv file
+        """
+        index = data_cache.read_index(set_directory)
+        if index is None or (csv_hash and str(index.get('csv_hash', '')) != csv_hash):
+            return None
+        try:
+            values = np.load(os.path.join(set_directory, factor_ingestion.PANEL_FILE), mmap_mode='r')
+        except (OSError, ValueError):
+            return None
+        if values.shape != (len(index['dates']), len(index['factors'])):
+            return None
+        source_hash = hashlib.sha1('\n'.join(index['source_keys'].tolist()).encode()).hexdigest()
+        return cls(index['dates'], index['factors'].tolist(), values, str(index['index_name']) or None, source_hash)
+
+    @classmethod
+    def from_cache(cls, file_path):
+        """ Builds the store from the compiled (memory mapped) form of the factors csv file
+
+        :param file_path: path of the csv file
+        :return: FactorStore
+        """
+        index, panels = data_cache.compiled_panels(file_path, _build_factor_panels, ['factors'])
+        return cls(index['dates'], index['factors'].tolist(), panels['factors'], str(index['index_name']) or None,
+                   str(index['source_hash']))
+
+    def rows(self, start_date=None, end_date=None):
+        """ Row slice of the dates between 2 dates (both included), found by binary search
+
+        :param start_date: first date, None for the beginning of the data
+        :param end_date: last date, None for the end of the data
+        :return: slice over the rows of values
+        """
+        first = 0 if start_date is None else np.searchsorted(self.dates, np.datetime64(pd.Timestamp(start_date), 'ns'),
+                                                             side='left')
+        last = len(self.dates) if end_date is None else np.searchsorted(self.dates,
+                                                                          np.datetime64(pd.Timestamp(end_date), 'ns'),
+                                                                          side='right')
+        return slice(first, last)
+
+    def window(self, factor_list, start_date=None, end_date=None):
+        """ Factor returns between 2 dates
+
+        :param factor_list: list of factor names
+        :param start_date: first date (included), None for the beginning of the data
+        :param end_date: last date (included), None for the end of the data
+        :return: DataFrame of factor returns
+        """
+        rows = self.rows(start_date, end_date)
+        cols = [self.columns[f] for f in factor_list]
+        if max(cols, default=0) < self.values.shape[1]:
+            values = self.values[rows][:, cols]
+        else:
+            values = np.hstack([self.values[rows], self.composite_values[rows]])[:, cols]
+        return pd.DataFrame(values, index=pd.DatetimeIndex(self.dates[rows], name=self.index_name),
+                            columns=list(factor_list))
+
+
+def _build_factor_panels(file_path):
+    """ Parses the factors csv file into the panel stored in its compiled form
+
+    :param file_path: path of the csv file
+    :return: dict of index arrays and dict with the factors panel
+    """
+    all_factors = pd.read_csv(file_path, index_col=0).ffill()
+    all_factors.index = pd.to_datetime(all_factors.index)
+    all_factors = all_factors * 0.01
+    index = {'dates': all_factors.index.values.astype('datetime64[ns]'),
+             'factors': np.array(all_factors.columns, dtype=str),
+             'index_name': np.array(all_factors.index.name or '')}
+
+    return index, {'factors': all_factors.values.astype(np.float64)}
+
+
+# factor stores by source ('csv' or 'set') and content hashes, and last seen (mtimes, store key) by csv file path
+_factor_stores = {}
+_factor_files = {}
+
+
+def factor_set_directory(file_path):
+    """ Directory of the factor set built from the raw factor files (Data/Factors/factor_raw_to_set.py), next to
+    the factors csv file
+
+    :param file_path: path of the factors csv file
+    :return: path of the factor set directory
+    """
+    return os.path.splitext(file_path)[0] + '_set'
+
+
+def get_factor_store(file_path=FACTORS_FILE):
+    """ Process wide factor store, read from the factor set when it was built with the current factors csv file
+    and from the csv file otherwise. The data is only loaded again when it changes
+
+    :param file_path: path of the factors csv file
+    :return: FactorStore
+    """
+    set_directory = factor_set_directory(file_path)
+    set_index = os.path.join(set_directory, data_cache.INDEX_FILE)
+    mtimes = tuple(os.path.getmtime(path) if os.path.exists(path) else None for path in (file_path, set_index))
+    if file_path in _factor_files and _factor_files[file_path][0] == mtimes:
+        return _factor_stores[_factor_files[file_path][1]]
+
+    csv_hash = data_cache.file_hash(file_path) if mtimes[0] is not None else ''
+    store_key = ('csv', csv_hash)
+    if mtimes[1] is not None:
+        set_key = ('set', data_cache.file_hash(set_index), csv_hash)
+        if set_key not in _factor_stores:
+            factor_store = FactorStore.from_set(set_directory, csv_hash)
+            if factor_store is not None:
+                factor_store.add_composites(COMPOSITE_FACTORS)
+                _factor_stores[set_key] = factor_store
+        if set_key in _factor_stores:
+            store_key = set_key
+    if store_key not in _factor_stores:
+        _factor_stores[store_key] = FactorStore.from_cache(file_path)
+        _factor_stores[store_key].add_composites(COMPOSITE_FACTORS)
+    _factor_files[file_path] = (mtimes, store_key)
+
+    return _factor_stores[store_key]
+
+
+def define_composite_factors(definitions, file_path=FACTORS_FILE):
+    """ Defines composite factors, see FactorStore.add_composites. A composite of the same name is replaced: its
+    returns are computed again in the stores already loaded.
+    Side effect: the definitions are written into the module level COMPOSITE_FACTORS for the rest of the process,
+    so stores built later in this process (or in processes forked from it) have them too; processes started with
+    spawn only see the composites defined at import.
+
+    :param definitions: dict of composite name to dict of base factor name to weight
+    :param file_path: path of the factors csv file
+    """
+    get_factor_store(file_path)
+    for factor_store in _factor_stores.values():
+        factor_store.add_composites(definitions)
+    COMPOSITE_FACTORS.update(definitions)
+
 
 def get_factors(factor_list, start_date=None, end_date=None, ):
     """
@@ -17,27 +238,22 @@ def get_factors(factor_list, start_date=None, end_date=None, ):
         'QMJ': Quality factor from AQR;
         'HML_Devil': Value factor with current market values from AQR;
         'UMD': Momentum factor from AQR
-        Other factor from MSCI available
+        Other factor from MSCI available, and the composite factors of COMPOSITE_FACTORS;
+        ['all'] for all the base factors (without composites)
     :param start_date: first factor data date using datetime package format
     :param end_date: last factor data date using datetime package format
     :return: factor(s) data as pandas Dataframe
     """
-    all_factors = pd.read_csv(r'Data\Factors\all_factors.csv', index_col=0).ffill()
-    all_factors.index = pd.to_datetime(all_factors.index)
+    factor_store = get_factor_store()
 
     if factor_list == ['all']:
-        if start_date is None and end_date is None:
-            r = all_factors
-        else:
-            r = all_factors.loc[start_date:end_date, :]
-    elif not all(elem in all_factors.columns.values for elem in factor_list):
+        # base factors only, composites are requested by name
+        factor_list = factor_store.factors[:factor_store.values.shape[1]]
+    elif not all(elem in factor_store.columns for elem in factor_list):
         print('Factor not found')
         print(factor_list)
         return
-    else:
-        if start_date is None and end_date is None:
-            r = all_factors.loc[:, factor_list]
-        else:
-            r = all_factors.loc[start_date:end_date, factor_list]
 
-    return r * 0.01
+    r = factor_store.window(factor_list, start_date, end_date)
+
+    return r
@@ -0,0 +1,123 @@
+# building the factor set from the raw factor files, described by a manifest of sources
+
+import os
+import json
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+import data_cache
+
+SOURCES_DIRECTORY = 'sources'
+PANEL_FILE = 'factors.npy'
+
+
+def read_source(file_path, source):
+    """ Reads the factors of one raw file, in one pass over the file
+
+    :param file_path: path of the raw file
+    :param source: manifest entry of the file, dict with
+        'columns': dict of raw column name to factor name;
+        'date_format': format of the dates of the first column (None to infer it);
+        'prices': True when the columns are index levels, turned into percentage returns
+    :return: DataFrame of factor returns in percentages, indexed by date
+    """
+    date_column = pd.read_csv(file_path, nrows=0, encoding='utf-8-sig').columns[0]
+    columns = source['columns']
+    factors = pd.read_csv(file_path, index_col=0, usecols=[date_column] + list(columns), encoding='utf-8-sig')
+    factors.index = pd.to_datetime(factors.index.astype(str).str.strip(), format=source.get('date_format'))
+    factors.index.name = 'DATE'
+    factors = factors.apply(pd.to_numeric, errors='coerce').rename(columns=columns)[list(columns.values())]
+    if source.get('prices', False):
+        factors = factors.ffill().pct_change() * 100
+
+    return factors
+
+
+def _source_key(source, file_hash):
+    # a source is parsed again when its file or its manifest entry changes
+    return json.dumps({'hash': file_hash, 'source': source}, sort_keys=True)
+
+
+def _part_path(set_directory, source):
+    return os.path.join(set_directory, SOURCES_DIRECTORY, os.path.splitext(source['file'])[0] + '.npz')
+
+
+def _read_part(path, key):
+    try:
+        with np.load(path, allow_pickle=False) as part:
+            if str(part['key']) != key:
+                return None
+            return pd.DataFrame(part['values'], index=pd.DatetimeIndex(part['dates'], name='DATE'),
+                                columns=part['factors'].tolist())
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def _write_part(path, key, factors):
+    arrays = {'key': np.array(key), 'dates': factors.index.values.astype('datetime64[ns]'),
+              'factors': np.array(factors.columns, dtype=str), 'values': factors.values.astype(np.float64)}
+    data_cache.write_atomic(path, lambda f: np.savez(f, **arrays))
+
+
+def build_factor_set(sources, raw_directory, set_directory, csv_path=None, factor_order=None, n_jobs=None):
+    """ Builds the factor set read by factor_data.get_factors.
+
+    Each raw file is read once for all its factors, the files that changed being parsed in parallel. The parsed
+    factors of every file are kept in the set directory with the hash of the file and its manifest entry, so a
+    rebuild only parses the files that changed since the last build. The factors are then aligned on the union
+    of their dates and written as a column major date x factor matrix of returns (forward filled and scaled from
+    percentages), memory mapped by factor_data.
+
+    :param sources: manifest, List of dicts with the 'file' name in raw_directory and the entries of read_source
+    :param raw_directory: directory of the raw files
+    :param set_directory: directory of the factor set (see factor_data.factor_set_directory)
+    :param csv_path: optional path where the factors (in percentages) are also written as csv; factor_data only
+        reads the set while this file is unchanged
+    :param factor_order: order of the factor columns, manifest order if None
+    :param n_jobs: number of processes parsing the files (os.cpu_count() if None)
+    :return: List of the files parsed by this build
+    """
+    keys = [_source_key(source, data_cache.file_hash(os.path.join(raw_directory, source['file'])))
+            for source in sources]
+    parts = [_read_part(_part_path(set_directory, source), key) for source, key in zip(sources, keys)]
+    stale = [i for i, part in enumerate(parts) if part is None]
+
+    if stale:
+        paths = [os.path.join(raw_directory, sources[i]['file']) for i in stale]
+        if n_jobs == 1 or len(stale) == 1:
+            parsed = [read_source(path, sources[i]) for path, i in zip(paths, stale)]
+        else:
+            with ProcessPoolExecutor(max_workers=min(n_jobs or os.cpu_count(), len(stale))) as executor:
+                parsed = list(executor.map(read_source, paths, [sources[i] for i in stale]))
+        os.makedirs(os.path.join(set_directory, SOURCES_DIRECTORY), exist_ok=True)
+        for i, factors in zip(stale, parsed):
+            _write_part(_part_path(set_directory, sources[i]), keys[i], factors)
+            parts[i] = factors
+
+    all_factors = pd.concat(parts, axis=1).sort_index()
+    if factor_order is not None:
+        all_factors = all_factors[factor_order]
+    if csv_path is not None:
+        all_factors.to_csv(csv_path)
+
+    panel = np.asfortranarray(all_factors.ffill().values * 0.01)
+    index = {'dates': all_factors.index.values.astype('datetime64[ns]'),
+             'factors': np.array(all_factors.columns, dtype=str),
+             'index_name': np.array(all_factors.index.name or ''),
+             'source_keys': np.array(keys),
+             # the set is only read while the csv file is the one written with it (factor_data.get_factor_store)
+             'csv_hash': np.array('' if csv_path is None else data_cache.file_hash(csv_path))}
+    index_path = os.path.join(set_directory, data_cache.INDEX_FILE)
+    try:
+        # without index the set is not read, so a panel left by an interrupted build is never paired with the
+        # dates and factors of the previous one
+        if os.path.exists(index_path):
+            os.remove(index_path)
+        data_cache.write_atomic(os.path.join(set_directory, PANEL_FILE), lambda f: np.save(f, panel))
+        # index written last, it marks the set as complete
+        data_cache.write_index(set_directory, index)
+    except OSError as e:
+        # panel memory mapped by another process on Windows: factor_data reads the csv file until the next build
+        print('Factor set not written: {}'.format(e))
+
+    return [sources[i]['file'] for i in stale]
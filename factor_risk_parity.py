@@ -3,9 +3,12 @@
 import pandas as pd
 import stock_data
 import factor_data
-import statsmodels.api as sm
 import numpy as np
 from scipy.optimize import minimize
+from rolling_estimators import RollingCovariance, RollingLoadings
+import parallel_backtest
+import risk_model_cache
+from backtest_checkpoint import BacktestCheckpoint
 from dateutil.relativedelta import relativedelta
 from alive_progress import alive_bar
 from alive_progress import config_handler
@@ -13,55 +16,267 @@ from alive_progress import config_handler
 config_handler.set_global(force_tty=True)
 
 
-def get_loading_matrix(stocks, factors):
-    """ Obtains factor to stocks loading matrix
+def get_loading_matrix(stocks, factors, rolling_loadings=None):
+    """ Obtains factor to stocks loading matrix, by least squares (no intercept) of all stocks at once
 
     :param stocks: DataFrame of all stocks considered
     :param factors: DataFrame of all factors considered
+    :param rolling_loadings: optional RollingLoadings reused across consecutive windows
     :return: Matrix with factor to stocks loadings
     """
-    model = sm.OLS(stocks, factors).fit()
-    parameters = model.params
-    loading_matrix = pd.DataFrame(data=parameters.values, index=parameters.index,
+    if not stocks.index.equals(factors.index):
+        raise ValueError('The indices for stocks and factors are not aligned')
+
+    if rolling_loadings is None:
+        # same solution as statsmodels OLS (pinv method) without building the results object
+        parameters = np.matmul(np.linalg.pinv(factors.values), stocks.values)
+    else:
+        parameters = rolling_loadings.update(stocks, factors)
+    loading_matrix = pd.DataFrame(data=parameters, index=factors.columns,
                                   columns=stocks.columns).T
 
     return loading_matrix
 
 
-def get_risk_contributions(asset_weights, loadings_matrix, Sigma):
+class FactorRiskModel:
+    """ Factor risk model of a rebalancing date: loadings matrix A, covariance matrix Sigma and the cached
+    pseudo-inverse A+ and A+ Sigma, so risk contributions are evaluated without an SVD at every call.
+    The quantities shared by the objective, its gradient and the constraints are kept for the last weights seen.
+    """
+
+    def __init__(self, loadings_matrix, Sigma, pseudo_inverse=None):
+        """
+        :param loadings_matrix: loading matrix of factors to stocks (stocks x factors)
+        :param Sigma: covariance matrix of stocks
+        :param pseudo_inverse: pseudo-inverse of the loadings matrix when already known (computed if None)
+        """
+        self.loadings_matrix = loadings_matrix
+        self.A = np.asarray(loadings_matrix, dtype=np.float64)
+        self.Sigma = Sigma
+        self.Aplus = np.linalg.pinv(self.A) if pseudo_inverse is None else pseudo_inverse
+        self.Aplus_Sigma = np.matmul(self.Aplus, Sigma)
+        self._x = None
+
+    def covariance_times(self, x):
+        """ Sigma x """
+        return np.matmul(self.Sigma, x)
+
+    def _evaluate(self, asset_weights):
+        x = np.asarray(asset_weights, dtype=np.float64)
+        if self._x is None or not np.array_equal(x, self._x):
+            Sigma_x = self.covariance_times(x)
+            vol_x = np.sqrt(np.matmul(x, Sigma_x))
+            AT_x = np.matmul(self.A.T, x)
+            Aplus_Sigma_x = np.matmul(self.Aplus_Sigma, x)
+            self._state = (Sigma_x, vol_x, AT_x, Aplus_Sigma_x, (AT_x * Aplus_Sigma_x) / vol_x)
+            self._x = x.copy()
+        return self._state
+
+    def volatility(self, asset_weights):
+        """ Portfolio volatility sqrt(x' Sigma x)
+
+        :param asset_weights: weight vector for all assets
+        :return: portfolio volatility
+        """
+        return self._evaluate(asset_weights)[1]
+
+    def risk_contributions(self, asset_weights):
+        """ Risk contributions of the factors to the portfolio
+
+        :param asset_weights: weight vector for all assets
+        :return: Risk contributions of factors to portfolio
+        """
+        return self._evaluate(asset_weights)[4]
+
+    def risk_contributions_jacobian(self, asset_weights):
+        """ Jacobian of the factor risk contributions with respect to the asset weights
+
+        With u = A'x, v = A+ Sigma x and vol = sqrt(x' Sigma x), RC_j = u_j v_j / vol and
+        dRC_j/dx = (v_j A_j + u_j (A+ Sigma)_j) / vol - RC_j Sigma x / vol^2
+
+        :param asset_weights: weight vector for all assets
+        :return: Matrix (factors x assets) of risk contribution derivatives
+        """
+        Sigma_x, vol_x, AT_x, Aplus_Sigma_x, risk_contributions = self._evaluate(asset_weights)
+        jacobian = (Aplus_Sigma_x[:, None] * self.A.T + AT_x[:, None] * self.Aplus_Sigma) / vol_x \
+            - np.outer(risk_contributions, Sigma_x) / vol_x ** 2
+
+        return jacobian
+
+
+class StructuredFactorRiskModel(FactorRiskModel):
+    """ Factor risk model with the structured covariance Sigma = A F A' + D, where F is the factor covariance
+    matrix and D the diagonal of idiosyncratic variances. Sigma is never formed: Sigma x, x' Sigma x and
+    A+ Sigma x cost O(n k) each instead of O(n^2), so memory and time no longer grow with the square of the universe.
+    """
+
+    def __init__(self, loadings_matrix, factor_covariance, idiosyncratic_variances, pseudo_inverse=None):
+        """
+        :param loadings_matrix: loading matrix of factors to stocks (stocks x factors)
+        :param factor_covariance: covariance matrix of the factors (factors x factors)
+        :param idiosyncratic_variances: variance of the residual returns of each stock
+        :param pseudo_inverse: pseudo-inverse of the loadings matrix when already known (computed if None)
+        """
+        self.loadings_matrix = loadings_matrix
+        self.A = np.asarray(loadings_matrix, dtype=np.float64)
+        self.F = np.asarray(factor_covariance, dtype=np.float64)
+        self.D = np.asarray(idiosyncratic_variances, dtype=np.float64)
+        self.Sigma = None
+        self.Aplus = np.linalg.pinv(self.A) if pseudo_inverse is None else pseudo_inverse
+        # A+ Sigma = (A+ A) F A' + A+ D, a k x n matrix
+        self.Aplus_Sigma = np.matmul(np.matmul(np.matmul(self.Aplus, self.A), self.F), self.A.T) \
+            + self.Aplus * self.D
+        self._x = None
+
+    @classmethod
+    def from_returns(cls, loadings_matrix, stocks, factors):
+        """ Builds the structured model from the returns the loadings were estimated on
+
+        :param loadings_matrix: loading matrix of factors to stocks
+        :param stocks: DataFrame of stock returns
+        :param factors: DataFrame of factor returns
+        :return: StructuredFactorRiskModel
+        """
+        A = np.asarray(loadings_matrix, dtype=np.float64)
+        residuals = stocks.values - np.matmul(factors.values, A.T)
+        return cls(loadings_matrix, factors.cov().values, residuals.var(axis=0, ddof=1))
+
+    def covariance_times(self, x):
+        """ Sigma x = A (F (A' x)) + D x """
+        return np.matmul(self.A, np.matmul(self.F, np.matmul(self.A.T, x))) + self.D * x
+
+
+def get_risk_contributions(asset_weights, loadings_matrix, Sigma, risk_model=None):
     """ Gets the risk contributions of risk factor to the portfolio
 
     :param asset_weights: weight vector for all assets
     :param loadings_matrix: loading matrix of factors to stocks
     :param Sigma: covariance matrix of stocks
+    :param risk_model: FactorRiskModel of loadings_matrix and Sigma, built when not given
     :return: Risk contributions of factors to portfolio
     """
-    # add size debug
-    x = asset_weights
+    if risk_model is None:
+        risk_model = FactorRiskModel(loadings_matrix, Sigma)
 
-    # change Sigma based of results from OLS
-    vol_x = np.sqrt(np.matmul(np.matmul(x, Sigma), x))
+    return risk_model.risk_contributions(asset_weights)
+
+
+def get_risk_contributions_jacobian(asset_weights, loadings_matrix, Sigma, risk_model=None):
+    """ Jacobian of the factor risk contributions with respect to the asset weights
+
+    :param asset_weights: weight vector for all assets
+    :param loadings_matrix: loading matrix of factors to stocks
+    :param Sigma: covariance matrix of stocks
+    :param risk_model: FactorRiskModel of loadings_matrix and Sigma, built when not given
+    :return: Matrix (factors x assets) of risk contribution derivatives
+    """
+    if risk_model is None:
+        risk_model = FactorRiskModel(loadings_matrix, Sigma)
+
+    return risk_model.risk_contributions_jacobian(asset_weights)
+
+
+def split_factor_tickers(factor_tickers):
+    """ Splits the factor tickers with cluster format into the flat list of factors and the cluster structure
+
+    :param factor_tickers: List of tickers of factor used and respective cluster format,
+        e.g. ['SMB', 'MOM', ['CMA', 'HML_Devil']]
+    :return: flat list of factor tickers and list with the number of factors of each cluster
+    """
+    factor_structure = []
+    factor_tickers_flat = []
+    for group in factor_tickers:
+        if type(group) is list:
+            factor_structure.append(len(group))
+            for factor in group:
+                factor_tickers_flat.append(factor)
+        else:
+            factor_structure.append(1)
+            factor_tickers_flat.append(group)
 
-    Aplus = np.linalg.pinv(loadings_matrix)
-    AT_x = np.matmul(loadings_matrix.values.T, x)
-    Aplus_Sigma_x = np.matmul(np.matmul(Aplus, Sigma), x)
+    return factor_tickers_flat, factor_structure
 
-    risk_contributions = (AT_x * Aplus_Sigma_x) / vol_x
 
-    return risk_contributions
+_cluster_matrices = {}
 
 
-def big_sigma(stock_returns):
+def cluster_matrix(factor_structure):
+    """ Matrix summing factor values into their clusters
+
+    :param factor_structure: number of factors in each cluster, e.g. [1, 1, 2, 3]
+    :return: Matrix (clusters x factors) of zeros and ones, shared between the calls with the same structure
+    """
+    key = tuple(factor_structure)
+    if key not in _cluster_matrices:
+        ends = np.cumsum(factor_structure)
+        matrix = np.zeros((len(factor_structure), ends[-1]))
+        for i, (start, end) in enumerate(zip(ends - factor_structure, ends)):
+            matrix[i, start:end] = 1
+        matrix.setflags(write=False)
+        _cluster_matrices[key] = matrix
+
+    return _cluster_matrices[key]
+
+
+def budget_constraint(n_stocks):
+    """ Equality constraint sum(x) = 1 for SLSQP, with its constant jacobian
+
+    :param n_stocks: number of assets
+    :return: SLSQP constraint dict
+    """
+    ones = np.ones(n_stocks)
+    return {'type': 'eq', 'fun': lambda x: np.dot(ones, x) - 1, 'jac': lambda x: ones}
+
+
+def exposure_constraints(exposure_matrix, lower, upper):
+    """ Inequality constraints lower <= E x <= upper for SLSQP as one stacked linear constraint, with its constant
+    jacobian built once
+
+    :param exposure_matrix: Matrix E mapping asset weights to exposures (e.g. A' or C A')
+    :param lower: lower bound of the exposures
+    :param upper: upper bound of the exposures
+    :return: SLSQP constraint dict
+    """
+    exposure_matrix = np.asarray(exposure_matrix, dtype=np.float64)
+    G = np.vstack([exposure_matrix, -exposure_matrix])
+    h = np.concatenate([np.full(exposure_matrix.shape[0], lower), np.full(exposure_matrix.shape[0], -upper)])
+    return {'type': 'ineq', 'fun': lambda x: np.matmul(G, x) - h, 'jac': lambda x: G}
+
+
+def big_sigma(stock_returns, rolling_covariance=None):
     """Get Covariance matrix of stock returns
 
     :param stock_returns: DataFrame of stock returns
+    :param rolling_covariance: optional RollingCovariance reused across consecutive windows
     :return: Covariance matrix
     """
-    sigma = stock_returns.cov().values
+    if rolling_covariance is None:
+        sigma = stock_returns.cov().values
+    else:
+        sigma = rolling_covariance.update(stock_returns)
 
     return sigma
 
 
+def get_risk_model(stocks, factors, loadings_matrix, covariance_model='sample', rolling_covariance=None):
+    """ Builds the risk model of a rebalancing date
+
+    :param stocks: DataFrame of stock returns
+    :param factors: DataFrame of factor returns
+    :param loadings_matrix: Factor to stocks loading matrix
+    :param covariance_model: 'sample' (full sample covariance) or 'factor' (structured A F A' + D covariance)
+    :param rolling_covariance: optional RollingCovariance reused across consecutive windows ('sample' only)
+    :return: stock covariance matrix (None for the structured model) and risk model
+    """
+    if covariance_model == 'sample':
+        sigma = big_sigma(stocks, rolling_covariance)
+        return sigma, FactorRiskModel(loadings_matrix, sigma)
+    elif covariance_model == 'factor':
+        return None, StructuredFactorRiskModel.from_returns(loadings_matrix, stocks, factors)
+    else:
+        raise ValueError("covariance_model must be 'sample' or 'factor'")
+
+
 def sigma_x(x, Sigma):
     """ volatility of portfolio
 
@@ -74,20 +289,110 @@ def sigma_x(x, Sigma):
     return vol_x
 
 
-def sigma_x_rc(x, loadings_matrix, sigma):
+def sigma_x_rc(x, loadings_matrix, sigma, risk_model=None):
     """ volatility of portfolio as sum of factor risk contributions
 
     :param x: asset weight vector
     :param loadings_matrix: factor to sotcks loading matrix
     :param sigma: assets covariance matrix
+    :param risk_model: FactorRiskModel of loadings_matrix and sigma, built when not given
     :return: portfolio volatility
     """
-    vol_x = get_risk_contributions(x, loadings_matrix, sigma).sum()
+    vol_x = get_risk_contributions(x, loadings_matrix, sigma, risk_model).sum()
 
     return vol_x
 
 
-def weights_factor_risk_parity(stocks, factor_structure, loadings_matrix, Sigma, x0):
+def solve_factor_risk_parity(risk_model, x0, clusters=None, weight_bounds=None, exposure_bounds=(-0.25, 1),
+                             max_iter=100, tol=1e-12):
+    """ Dedicated factor risk parity solver: Levenberg-Marquardt on the k risk parity residuals.
+
+    The residuals are r = RC / vol - 1/k (or, with clusters, r = C RC / sum(RC) - 1/m). Each step solves a k x k
+    system using the risk model's cached A+ Sigma, and steps are projected so the budget sum(x) = 1 is kept.
+    Bounds and exposure constraints are not enforced; the solution is reported as infeasible when one of them is
+    violated, in which case the caller should fall back to SLSQP.
+
+    :param risk_model: FactorRiskModel of the rebalancing date
+    :param x0: asset weights vector for initialization
+    :param clusters: cluster matrix (clusters x factors) for shared risk contributions, None for one budget per factor
+    :param weight_bounds: (lower, upper) bounds of the asset weights, (-1/n, 1) if None
+    :param exposure_bounds: (lower, upper) bounds of the factor (and cluster) exposures A'x
+    :param max_iter: maximum number of iterations
+    :param tol: tolerance on the objective sum(r^2); a projected gradient norm below tol with a larger objective is
+        a stall
+    :return: asset weights vector and dict with 'fun', 'n_iter', 'converged' (objective below tol), 'stalled' (no
+        descent step or a vanishing gradient before convergence, e.g. at a local minimum with non zero residuals)
+        and 'feasible'
+    """
+    x = np.array(x0, dtype=np.float64)
+    n_stocks = x.shape[0]
+    n_factors = risk_model.A.shape[1]
+    x += (1 - x.sum()) / n_stocks
+    if weight_bounds is None:
+        weight_bounds = (-1 / n_stocks, 1)
+
+    def residuals(x):
+        risk_contributions = risk_model.risk_contributions(x)
+        J = risk_model.risk_contributions_jacobian(x)
+        if clusters is None:
+            vol_x = risk_model.volatility(x)
+            r = risk_contributions / vol_x - 1 / n_factors
+            Jr = J / vol_x - np.outer(risk_contributions, risk_model.covariance_times(x)) / vol_x ** 3
+        else:
+            total_risk_contributions = risk_contributions.sum()
+            clusters_rcs = np.matmul(clusters, risk_contributions)
+            r = clusters_rcs / total_risk_contributions - 1 / clusters.shape[0]
+            Jr = np.matmul(clusters, J) / total_risk_contributions \
+                - np.outer(clusters_rcs, J.sum(axis=0)) / total_risk_contributions ** 2
+        # projection on sum(step) = 0
+        return r, Jr - Jr.mean(axis=1, keepdims=True)
+
+    r, Jr = residuals(x)
+    f = np.dot(r, r)
+    damping = 1e-6
+    converged = False
+    stalled = False
+    n_iter = 0
+    while n_iter < max_iter:
+        if f <= tol:
+            converged = True
+            break
+        if np.linalg.norm(2 * np.matmul(Jr.T, r)) <= tol:
+            # stationary point with non zero residuals: a local minimum, not a risk parity solution
+            stalled = True
+            break
+        n_iter += 1
+        JJt = np.matmul(Jr, Jr.T)
+        scale = np.trace(JJt) / len(r)
+        while damping < 1e6:
+            step = -np.matmul(Jr.T, np.linalg.solve(JJt + damping * scale * np.eye(len(r)), r))
+            r_new, Jr_new = residuals(x + step)
+            f_new = np.dot(r_new, r_new)
+            if f_new < f:
+                x, r, Jr, f = x + step, r_new, Jr_new, f_new
+                damping = max(damping / 10, 1e-12)
+                break
+            damping *= 10
+        else:
+            # no descent step left: stationary point of the residuals, a solution only when they vanish
+            stalled = True
+            converged = f <= tol
+            break
+
+    exposures = np.matmul(risk_model.A.T, x)
+    if clusters is not None:
+        exposures = np.concatenate([exposures, np.matmul(clusters, exposures)])
+    feasible = bool(np.all(x >= weight_bounds[0] - 1e-10) and np.all(x <= weight_bounds[1] + 1e-10)
+                    and np.all(exposures >= exposure_bounds[0] - 1e-10)
+                    and np.all(exposures <= exposure_bounds[1] + 1e-10))
+    if clusters is not None:
+        feasible = feasible and bool(np.all(risk_model.risk_contributions(x) >= -1e-10))
+
+    return x, {'fun': f, 'n_iter': n_iter, 'converged': converged, 'stalled': stalled, 'feasible': feasible}
+
+
+def weights_factor_risk_parity(stocks, factor_structure, loadings_matrix, Sigma, x0, risk_model=None,
+                               solver='slsqp', solver_options=None):
     """ Calculates assets weights according to the factor risk parity approach
 
     :param stocks: DataFrame of stock returns
@@ -95,25 +400,40 @@ def weights_factor_risk_parity(stocks, factor_structure, loadings_matrix, Sigma,
     :param loadings_matrix: Factor to stocks loading matrix
     :param Sigma: stock returns covariance matrix
     :param x0: asset weighs vector for initialization
+    :param risk_model: FactorRiskModel of loadings_matrix and Sigma, built when not given
+    :param solver: 'slsqp', or 'lm' for the Levenberg-Marquardt solver solve_factor_risk_parity with SLSQP as fallback
+        when it does not converge or a bound or exposure constraint is active
+    :param solver_options: dict of max_iter and tol given to solve_factor_risk_parity
     :return: asset weights vector using factor risk parity method
     """
 
     n_stocks = stocks.shape[1]
+    n_factors = loadings_matrix.shape[1]
     if x0 is None:
         x0 = np.ones(n_stocks) * 1 / n_stocks
-    sigma = big_sigma(stocks)
+    if risk_model is None:
+        risk_model = FactorRiskModel(loadings_matrix, Sigma)
 
-    def square(listt):
-        return [i ** 2 for i in listt]
+    if solver == 'lm':
+        x, info = solve_factor_risk_parity(risk_model, x0, **(solver_options or {}))
+        if info['converged'] and info['feasible']:
+            print(info['fun'])
+            return x
 
-    fun = lambda x: sum(square(get_risk_contributions(x, loadings_matrix, Sigma) /
-                               sigma_x(x, sigma) - 1 /
-                               loadings_matrix.shape[1]))
+    def fun(x):
+        g = risk_model.risk_contributions(x) / risk_model.volatility(x) - 1 / n_factors
+        return np.sum(g ** 2)
+
+    def jac(x):
+        # f = sum_j (RC_j / vol - 1/k)^2
+        vol_x = risk_model.volatility(x)
+        risk_contributions = risk_model.risk_contributions(x)
+        g = risk_contributions / vol_x - 1 / n_factors
+        return 2 * (np.matmul(risk_model.risk_contributions_jacobian(x).T, g) / vol_x
+                    - np.dot(g, risk_contributions) * risk_model.covariance_times(x) / vol_x ** 3)
     # constrains
-    cons = [{'type': 'ineq', 'fun': lambda x: -sum(x) + 1},
-            {'type': 'ineq', 'fun': lambda x: sum(x) - 1},
-            {'type': 'ineq', 'fun': lambda x: np.matmul(loadings_matrix.values.T, x) - (-0.25)},
-            {'type': 'ineq', 'fun': lambda x: -np.matmul(loadings_matrix.values.T, x) + 1}
+    cons = [budget_constraint(n_stocks),
+            exposure_constraints(loadings_matrix.values.T, -0.25, 1)
             ]
 
     # bounds
@@ -121,82 +441,210 @@ def weights_factor_risk_parity(stocks, factor_structure, loadings_matrix, Sigma,
     bounds_long = [(0, 1) for n in range(n_stocks)]
     bounds = bounds_short_lev
 
-    res = minimize(fun, x0, method='SLSQP', bounds=bounds, constraints=cons, tol=1e-5, options={'disp': False})
+    res = minimize(fun, x0, jac=jac, method='SLSQP', bounds=bounds, constraints=cons, tol=1e-5,
+                   options={'disp': False})
     print(res.fun)
     return res.x
 
 
-def portfolio_weights_factor_risk_parity(tickers, factor_tickers, start_date, end_date, portfolio_rebalance_period):
+def factor_risk_parity_on_date(t, x0, state, tickers, factor_tickers_flat, factor_structure,
+                               covariance_model='sample', solver='slsqp'):
+    """ Factor risk parity weights of one rebalancing date, using the 12 months of returns up to the date
+
+    :param t: rebalancing date
+    :param x0: asset weights vector for initialization (None for equal weights)
+    :param state: dict kept between consecutive dates, holding the rolling estimators
+    :param tickers: List of tickers of all candidate stocks to the portfolio
+    :param factor_tickers_flat: List of tickers of factor used
+    :param factor_structure: Structure of factor clusters (factors that share risk budgets)
+    :param covariance_model: 'sample' or 'factor', see get_risk_model
+    :param solver: 'slsqp' or 'lm'
+    :return: asset weights vector
+    """
+    rolling_covariance = state.setdefault('rolling_covariance', RollingCovariance())
+    rolling_loadings = state.setdefault('rolling_loadings', RollingLoadings())
+
+    stocks = stock_data.get_daily_returns(tickers, t + relativedelta(months=-12), t)[1:]
+    # the risk model is kept for the attribution of the portfolio (performance_measures)
+    cache = risk_model_cache.get_risk_model_cache()
+    key = cache.key(tickers, factor_tickers_flat, t, 12, covariance_model)
+    risk_model = cache.get(key)
+    if risk_model is None:
+        factors = factor_data.get_factors(factor_tickers_flat, stocks.index[0], stocks.index[-1])
+        loadings_matrix = get_loading_matrix(stocks, factors, rolling_loadings)
+        sigma, risk_model = get_risk_model(stocks, factors, loadings_matrix, covariance_model, rolling_covariance)
+        cache.put(key, risk_model)
+    loadings_matrix, sigma = risk_model.loadings_matrix, risk_model.Sigma
+    x = weights_factor_risk_parity_shared_rc(stocks, factor_structure, loadings_matrix, sigma, x0, risk_model, solver)
+    print((risk_model.risk_contributions(x) / sigma_x_rc(x, loadings_matrix, sigma, risk_model)))
+    print(np.matmul(loadings_matrix.T, x))
+
+    return x
+
+
+def factor_risk_parity_on_date_clustered(t, x0, state, tickers, factor_structures, covariance_model='sample',
+                                         solver='slsqp'):
+    """ Factor risk parity weights of one rebalancing date with the factor clusters of that date.
+    While the structure does not change the rolling estimators keep being updated and the cluster matrix is reused;
+    when it changes the factor order changes and the loadings are rebuilt for the new order.
+
+    :param t: rebalancing date
+    :param x0: asset weights vector for initialization (None for equal weights)
+    :param state: dict kept between consecutive dates, holding the rolling estimators and the current structure
+    :param tickers: List of tickers of all candidate stocks to the portfolio
+    :param factor_structures: Series of factor tickers in cluster format for each rebalancing date
+    :param covariance_model: 'sample' or 'factor', see get_risk_model
+    :param solver: 'slsqp' or 'lm'
+    :return: asset weights vector
+    """
+    factor_tickers = factor_structures.loc[t]
+    if state.get('factor_tickers') != factor_tickers:
+        state['factor_tickers'] = factor_tickers
+        state['split_factor_tickers'] = split_factor_tickers(factor_tickers)
+
+    return factor_risk_parity_on_date(t, x0, state, tickers, *state['split_factor_tickers'], covariance_model, solver)
+
+
+def factor_risk_parity_strategy(window, x0, solver='slsqp'):
+    """ Factor risk parity weights of a rebalance_pipeline.RebalanceWindow
+
+    :param window: RebalanceWindow of the rebalancing date
+    :param x0: asset weights vector for initialization (None for equal weights)
+    :param solver: 'slsqp' or 'lm'
+    :return: asset weights vector
+    """
+    sigma = window.sigma if window.covariance_model == 'sample' else None
+
+    return weights_factor_risk_parity_shared_rc(window.stocks, window.factor_structure, window.loadings_matrix, sigma,
+                                                x0, window.risk_model, solver)
+
+
+def portfolio_weights_factor_risk_parity(tickers, factor_tickers, start_date, end_date, portfolio_rebalance_period,
+                                         covariance_model='sample', solver='slsqp', n_jobs=1, warm_start='chained',
+                                         checkpoint_file=None):
     """ Applies factor risk parity over a period of time. Can be used for back testing
 
     :param tickers: List of tickers of all candidate stocks to the portfolio
-    :param factor_tickers: List of tickers of factor used and respective cluster format
+    :param factor_tickers: List of tickers of factor used and respective cluster format, or Series of such lists for
+        each rebalancing date (see factor_screening.rolling_factor_structures)
     :param start_date: first date of the investment period
     :param end_date: last date of the investment period
     :param portfolio_rebalance_period: portfolio re-balancing period (monthly, weekly, etc.)
+    :param covariance_model: 'sample' for the sample covariance of stock returns, 'factor' for the structured
+        factor covariance (StructuredFactorRiskModel), which scales to large universes
+    :param solver: 'slsqp' or 'lm' (dedicated solver with SLSQP fallback)
+    :param n_jobs: number of processes, above 1 the dates are spread over a process pool (see parallel_backtest)
+    :param warm_start: with n_jobs above 1, 'chained' warm starts inside each block of dates or 'cold' starts
+    :param checkpoint_file: optional file where each completed date is appended; dates already in the file are not
+        solved again, so an interrupted back test resumes where it stopped and a later end_date extends it (with a
+        Series of factor tickers the file records every date's structure, so it only resumes the same Series)
     :return: DataFrame of asset weight vectors for each portfolio rebalancing date
     """
-    factor_structure = []
-    factor_tickers_flat = []
-    for group in factor_tickers:
-        if type(group) is list:
-            factor_structure.append(len(group))
-            for factor in group:
-                factor_tickers_flat.append(factor)
-        else:
-            factor_structure.append(1)
-            factor_tickers_flat.append(group)
-
     business_days_end_months = pd.date_range(start_date, end_date, freq=portfolio_rebalance_period)
-    portfolio_weights = pd.DataFrame(index=business_days_end_months, columns=tickers)
+    if isinstance(factor_tickers, pd.Series):
+        weights_on_date = factor_risk_parity_on_date_clustered
+        args = (tickers, factor_tickers, covariance_model, solver)
+        # the structure of every date, a checkpoint written with another clustering is refused
+        settings_factor_tickers = {pd.Timestamp(t).strftime('%Y-%m-%d'): structure
+                                   for t, structure in factor_tickers.items()}
+    else:
+        weights_on_date = factor_risk_parity_on_date
+        args = (tickers, *split_factor_tickers(factor_tickers), covariance_model, solver)
+        settings_factor_tickers = factor_tickers
+    checkpoint = None
+    if checkpoint_file is not None:
+        checkpoint = BacktestCheckpoint(checkpoint_file, tickers,
+                                        {'factor_tickers': settings_factor_tickers,
+                                         'covariance_model': covariance_model, 'solver': solver})
+    if n_jobs != 1:
+        return parallel_backtest.run_rebalance_dates(weights_on_date, business_days_end_months, tickers,
+                                                     args, n_jobs, warm_start, checkpoint=checkpoint)
+
+    portfolio_weights = pd.DataFrame(index=business_days_end_months, columns=tickers, dtype=np.float64)
+    completed = {}
+    saved_date, saved_state = None, {}
+    if checkpoint is not None:
+        completed = checkpoint.load()
+        saved_date, saved_state = checkpoint.load_state()
+        if saved_date is not None:
+            # dates solved after the last saved state are solved again from it, as in an uninterrupted run
+            completed = {t: x for t, x in completed.items() if t <= saved_date}
     x0 = None
+    state = {}
     with alive_bar(len(business_days_end_months)) as bar:
         for t in business_days_end_months:
-            stocks = stock_data.get_daily_returns(tickers, t + relativedelta(months=-12), t)[1:]
-            factors = factor_data.get_factors(factor_tickers_flat, stocks.index[0], stocks.index[-1])
-            loadings_matrix = get_loading_matrix(stocks, factors)
-            sigma = big_sigma(stocks)
-            portfolio_weights.loc[t] = weights_factor_risk_parity_shared_rc(stocks, factor_structure, loadings_matrix,
-                                                                            sigma, x0)
+            if t in completed:
+                portfolio_weights.loc[t] = completed[t]
+            else:
+                if not state and x0 is not None and x0.name == saved_date:
+                    # resuming after the date of the saved state: restore its rolling estimators
+                    state = saved_state
+                portfolio_weights.loc[t] = weights_on_date(t, x0, state, *args)
+                if checkpoint is not None:
+                    checkpoint.append(t, portfolio_weights.loc[t], state)
             x0 = portfolio_weights.loc[t]
-            print((get_risk_contributions(x0, loadings_matrix, sigma) / sigma_x_rc(x0, loadings_matrix, sigma)))
-            print(np.matmul(loadings_matrix.T, x0))
             bar()
+    if checkpoint is not None and x0 is not None:
+        checkpoint.flush_state(x0.name, state)
 
     return portfolio_weights
 
 
-def weights_factor_risk_parity_shared_rc(stocks, factor_structure, loadings_matrix, Sigma, x0):
+def weights_factor_risk_parity_shared_rc(stocks, factor_structure, loadings_matrix, Sigma, x0, risk_model=None,
+                                         solver='slsqp', solver_options=None):
+    """ Calculates assets weights according to the factor risk parity approach, with factors of the same cluster
+    sharing one risk budget
+
+    :param stocks: DataFrame of stock returns
+    :param factor_structure: Structure of factor clusters (factors that share risk budgets)
+    :param loadings_matrix: Factor to stocks loading matrix
+    :param Sigma: stock returns covariance matrix
+    :param x0: asset weighs vector for initialization
+    :param risk_model: FactorRiskModel of loadings_matrix and Sigma, built when not given
+    :param solver: 'slsqp', or 'lm' for the Levenberg-Marquardt solver solve_factor_risk_parity with SLSQP as fallback
+        when it does not converge or a constraint is active
+    :param solver_options: dict of max_iter and tol given to solve_factor_risk_parity
+    :return: asset weights vector using factor risk parity method
+    """
 
     n_stocks = stocks.shape[1]
     if x0 is None:
         x0 = np.ones(n_stocks) * 1 / n_stocks
-    # sigma = big_sigma(stocks)
+    if risk_model is None:
+        risk_model = FactorRiskModel(loadings_matrix, Sigma)
 
-    def square(listt):
-        return [i ** 2 for i in listt]
+    clusters = cluster_matrix(factor_structure)
+
+    if solver == 'lm':
+        x, info = solve_factor_risk_parity(risk_model, x0, clusters, **(solver_options or {}))
+        if info['converged'] and info['feasible']:
+            print(info['fun'])
+            return x
 
     def fun(x):
-        risk_contributions = get_risk_contributions(x, loadings_matrix, Sigma)
-        total_risk_contributions = sum(risk_contributions)
-        clusters_rcs = [part.sum() for part in np.split(risk_contributions, np.cumsum(factor_structure))[:-1]]
-        f = sum(square(clusters_rcs / total_risk_contributions - 1 / len(factor_structure)))
+        risk_contributions = risk_model.risk_contributions(x)
+        total_risk_contributions = risk_contributions.sum()
+        clusters_rcs = np.matmul(clusters, risk_contributions)
+        f = np.sum((clusters_rcs / total_risk_contributions - 1 / len(factor_structure)) ** 2)
         return f
 
+    def jac(x):
+        # f = sum_i (C_i RC / sum(RC) - 1/m)^2, chain rule through the risk contributions jacobian
+        risk_contributions = risk_model.risk_contributions(x)
+        total_risk_contributions = risk_contributions.sum()
+        clusters_rcs = np.matmul(clusters, risk_contributions)
+        g = clusters_rcs / total_risk_contributions - 1 / len(factor_structure)
+        w = np.matmul(clusters.T, g) / total_risk_contributions \
+            - np.dot(g, clusters_rcs) / total_risk_contributions ** 2
+        return 2 * np.matmul(risk_model.risk_contributions_jacobian(x).T, w)
+
     # constrains
-    cons = [{'type': 'ineq', 'fun': lambda x: -sum(x) + 1},
-            {'type': 'ineq', 'fun': lambda x: sum(x) - 1},
-            {'type': 'ineq',
-             'fun': lambda x: np.array([part.sum() for part in np.split(np.matmul(loadings_matrix.values.T, x),
-                                                                        np.cumsum(factor_structure))[:-1]]) - (
-                                  -.25)},
-            {'type': 'ineq',
-             'fun': lambda x: -np.array([part.sum() for part in np.split(np.matmul(loadings_matrix.values.T, x),
-                                                                         np.cumsum(factor_structure))[:-1]])
-                              + 1},
-            {'type': 'ineq', 'fun': lambda x: np.matmul(loadings_matrix.values.T, x) - (-.25)},
-            {'type': 'ineq', 'fun': lambda x: -np.matmul(loadings_matrix.values.T, x) + 1},
-            {'type': 'ineq', 'fun': lambda x: get_risk_contributions(x, loadings_matrix, Sigma) - 0}
+    AT = loadings_matrix.values.T
+    cons = [budget_constraint(n_stocks),
+            exposure_constraints(np.matmul(clusters, AT), -.25, 1),
+            exposure_constraints(AT, -.25, 1),
+            {'type': 'ineq', 'fun': lambda x: risk_model.risk_contributions(x) - 0,
+             'jac': lambda x: risk_model.risk_contributions_jacobian(x)}
             ]
     # avoid negative RC in the last equation for the shared RC case
     # bounds
@@ -204,43 +652,44 @@ def weights_factor_risk_parity_shared_rc(stocks, factor_structure, loadings_matr
     bounds_long = [(0, 1) for n in range(n_stocks)]
     bounds = bounds_short_lev
 
-    res = minimize(fun, x0, method='SLSQP', bounds=bounds, constraints=cons, tol=1e-5, options={'disp': False})
+    res = minimize(fun, x0, jac=jac, method='SLSQP', bounds=bounds, constraints=cons, tol=1e-5,
+                   options={'disp': False})
     print(res.fun)
     return res.x
 
 
 def portfolio_weights_factor_risk_parity_intersection(tickers, factor_tickers, start_date, end_date,
-                                                      portfolio_rebalance_period):
+                                                      portfolio_rebalance_period, covariance_model='sample',
+                                                      solver='slsqp'):
+    """ Factor risk parity on factors and intersections of factors, the intersections being composite factors of
+    factor_data.COMPOSITE_FACTORS requested by name, e.g. ['SMB', 'MOM', 'CMA_HML_Devil', 'BaB_RMW_QMJ']
 
-    factor_structure = []
-    factor_tickers_flat = []
-    for group in factor_tickers:
-        if type(group) is list:
-            factor_structure.append(len(group))
-            for factor in group:
-                factor_tickers_flat.append(factor)
-        else:
-            factor_structure.append(1)
-            factor_tickers_flat.append(group)
+    :param tickers: List of tickers of stocks used
+    :param factor_tickers: List of tickers of factors and composite factors used, with cluster format
+    :param start_date: first date of the investment period
+    :param end_date: last date of the investment period
+    :param portfolio_rebalance_period: portfolio re-balancing period (monthly, weekly, etc.)
+    :param covariance_model: 'sample' or 'factor', see get_risk_model
+    :param solver: 'slsqp' or 'lm', see weights_factor_risk_parity
+    :return: DataFrame of asset weights for each rebalancing date
+    """
+    factor_tickers_flat, factor_structure = split_factor_tickers(factor_tickers)
 
     business_days_end_months = pd.date_range(start_date, end_date, freq=portfolio_rebalance_period)
-    portfolio_weights = pd.DataFrame(index=business_days_end_months, columns=tickers)
+    portfolio_weights = pd.DataFrame(index=business_days_end_months, columns=tickers, dtype=np.float64)
     x0 = None
+    rolling_covariance = RollingCovariance()
+    rolling_loadings = RollingLoadings()
     with alive_bar(len(business_days_end_months)) as bar:
         for t in business_days_end_months:
             stocks = stock_data.get_daily_returns(tickers, t + relativedelta(months=-12), t)[1:]
             factors = factor_data.get_factors(factor_tickers_flat, stocks.index[0], stocks.index[-1])
-            #factor intersection
-            f1 = factors['SMB']
-            f2 = factors['MOM']
-            f3 = factors['CMA'] * 0.5 + factors['HML_Devil'] * 0.5
-            f4 = factors['BaB'] * 0.5 + factors['RMW'] * 0.25 + factors['QMJ'] * 0.25
-            factors = pd.DataFrame([f1, f2, f3, f4]).T
-            loadings_matrix = get_loading_matrix(stocks, factors)
-            sigma = big_sigma(stocks)
-            portfolio_weights.loc[t] = weights_factor_risk_parity(stocks, factor_structure, loadings_matrix, sigma, x0)
+            loadings_matrix = get_loading_matrix(stocks, factors, rolling_loadings)
+            sigma, risk_model = get_risk_model(stocks, factors, loadings_matrix, covariance_model, rolling_covariance)
+            portfolio_weights.loc[t] = weights_factor_risk_parity(stocks, factor_structure, loadings_matrix, sigma, x0,
+                                                                  risk_model, solver)
             x0 = portfolio_weights.loc[t]
-            print((get_risk_contributions(x0, loadings_matrix, sigma) / sigma_x_rc(x0, loadings_matrix, sigma)))
+            print((risk_model.risk_contributions(x0) / sigma_x_rc(x0, loadings_matrix, sigma, risk_model)))
             print(np.matmul(loadings_matrix.T, x0))
             bar()
 
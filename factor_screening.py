@@ -0,0 +1,155 @@
+# correlation tests and correlation clustering of many factor return series at once
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+import scipy.cluster.hierarchy as spc
+from scipy.spatial.distance import squareform
+from dateutil.relativedelta import relativedelta
+import factor_data
+from rolling_estimators import RollingCovariance
+
+
+def correlation_tests(factor_returns, pairwise=False):
+    """ Pearson correlation matrix of the factors with the t-statistics and p-values of the correlations, computed
+    with matrix products instead of one pearsonr call per pair
+
+    :param factor_returns: DataFrame of factor returns (one column per factor)
+    :param pairwise: use for each pair of factors all the days where both are known (as DataFrame.corr), instead of
+        only the days where every factor is known (as pearsonr on factor_returns.dropna())
+    :return: DataFrames of correlations, t-statistics, p-values (two-sided) and number of observations of each pair
+    """
+    data = factor_returns.select_dtypes(include=np.number)
+    if not pairwise:
+        data = data.dropna()
+    values = np.asarray(data.values, dtype=np.float64)
+    valid = ~np.isnan(values)
+    # centered on the column means for precision, the pairwise means are removed below
+    x = np.where(valid, values - np.nanmean(values, axis=0), 0)
+    m = valid.astype(np.float64)
+
+    n_obs = np.matmul(m.T, m)
+    sums = np.matmul(x.T, m)  # sums[i, j]: sum of factor i over the days where factor j is known
+    squares = np.matmul((x ** 2).T, m)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        covariance = np.matmul(x.T, x) - sums * sums.T / n_obs
+        variance = squares - sums ** 2 / n_obs
+        corr = np.clip(covariance / np.sqrt(variance * variance.T), -1, 1)
+        np.fill_diagonal(corr, np.where(np.diag(variance) > 0, 1, np.nan))
+        dof = n_obs - 2
+        t_stats = corr * np.sqrt(dof / (1 - corr ** 2))
+    p_values = np.where(dof > 0, 2 * stats.t.sf(np.abs(t_stats), np.maximum(dof, 1)), np.nan)
+
+    def frame(matrix):
+        return pd.DataFrame(matrix, index=data.columns, columns=data.columns)
+
+    return frame(corr), frame(t_stats), frame(p_values), frame(n_obs.astype(int))
+
+
+def _distance(corr, absolute=False):
+    """ Condensed correlation distance matrix from a correlation matrix """
+    distance = 1 - (np.abs(corr) if absolute else corr)
+    np.fill_diagonal(distance, 0)
+
+    return squareform(np.maximum((distance + distance.T) / 2, 0), checks=False)
+
+
+def _clusters(distance, threshold, method):
+    """ Linkage of a condensed distance matrix and its cluster numbers, cut at threshold times the largest distance """
+    linkage = spc.linkage(distance, method=method)
+    return spc.fcluster(linkage, threshold * distance.max(), 'distance'), linkage
+
+
+def correlation_distance(factor_returns, absolute=False, pairwise=False):
+    """ Condensed correlation distance matrix of the factors, 1 - correlation (as pdist with the correlation metric)
+
+    :param factor_returns: DataFrame of factor returns
+    :param absolute: use 1 - |correlation|, so strongly anti-correlated factors are also close
+    :param pairwise: pairwise handling of missing values, see correlation_tests
+    :return: condensed distance matrix
+    """
+    return _distance(correlation_tests(factor_returns, pairwise)[0].values, absolute)
+
+
+def cluster_factors(factor_returns, threshold=0.5, method='complete', absolute=False, pairwise=False):
+    """ Hierarchical clustering of the factors on their correlation distance
+
+    :param factor_returns: DataFrame of factor returns
+    :param threshold: clusters are cut at threshold times the largest distance between two factors
+    :param method: linkage method (see scipy.cluster.hierarchy.linkage)
+    :param absolute: cluster on 1 - |correlation|
+    :param pairwise: pairwise handling of missing values, see correlation_tests
+    :return: Series of the cluster number of each factor, linkage matrix and condensed distance matrix
+    """
+    distance = correlation_distance(factor_returns, absolute, pairwise)
+    labels, linkage = _clusters(distance, threshold, method)
+
+    return pd.Series(labels, index=factor_returns.columns, name='Cluster'), linkage, distance
+
+
+def factor_tickers_from_clusters(labels):
+    """ Factor tickers in the cluster format used by the portfolio construction, e.g. ['SMB', ['CMA', 'HML_Devil']].
+    Clusters are ordered by their first factor and factors keep their order inside a cluster.
+
+    :param labels: Series of the cluster number of each factor
+    :return: List of tickers of single factor clusters and lists of tickers of larger clusters
+    """
+    clusters = {}
+    for factor, label in labels.items():
+        clusters.setdefault(label, []).append(factor)
+
+    return [cluster if len(cluster) > 1 else cluster[0] for cluster in clusters.values()]
+
+
+class RollingFactorClustering:
+    """ Clustering of the factors over a rolling window, the factor covariance being updated incrementally
+    (rolling_estimators.RollingCovariance) and the linkage recomputed at each date
+    """
+
+    def __init__(self, threshold=0.5, method='complete', absolute=False):
+        """
+        :param threshold: clusters are cut at threshold times the largest distance between two factors
+        :param method: linkage method (see scipy.cluster.hierarchy.linkage)
+        :param absolute: cluster on 1 - |correlation|
+        """
+        self.threshold = threshold
+        self.method = method
+        self.absolute = absolute
+        self.rolling_covariance = RollingCovariance()
+
+    def update(self, factor_returns):
+        """ Moves the window to the given factor returns and clusters the factors
+
+        :param factor_returns: DataFrame of factor returns of the new window
+        :return: factor tickers in cluster format, see factor_tickers_from_clusters
+        """
+        covariance = self.rolling_covariance.update(factor_returns)
+        std = np.sqrt(np.diag(covariance))
+        labels, _ = _clusters(_distance(covariance / np.outer(std, std), self.absolute), self.threshold, self.method)
+
+        return factor_tickers_from_clusters(pd.Series(labels, index=factor_returns.columns))
+
+
+def rolling_factor_structures(factor_tickers, start_date, end_date, portfolio_rebalance_period, lookback_months=60,
+                              threshold=0.5, method='complete', absolute=False):
+    """ Factor cluster structure of each rebalancing date, from the factor returns of the lookback window
+
+    :param factor_tickers: flat List of tickers of the candidate factors
+    :param start_date: first date of the investment period
+    :param end_date: last date of the investment period
+    :param portfolio_rebalance_period: portfolio re-balancing period (monthly, weekly, etc.)
+    :param lookback_months: length of the clustering window in months
+    :param threshold: clusters are cut at threshold times the largest distance between two factors
+    :param method: linkage method (see scipy.cluster.hierarchy.linkage)
+    :param absolute: cluster on 1 - |correlation|
+    :return: Series of factor tickers in cluster format for each rebalancing date, to be given as factor_tickers to
+        factor_risk_parity.portfolio_weights_factor_risk_parity
+    """
+    business_days_end_months = pd.date_range(start_date, end_date, freq=portfolio_rebalance_period)
+    clustering = RollingFactorClustering(threshold, method, absolute)
+    structures = []
+    for t in business_days_end_months:
+        factor_returns = factor_data.get_factors(factor_tickers, t + relativedelta(months=-lookback_months), t)
+        structures.append(clustering.update(factor_returns.dropna()))
+
+    return pd.Series(structures, index=business_days_end_months, name='Factor tickers', dtype=object)
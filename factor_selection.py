@@ -1,6 +1,7 @@
 # brief risk factor analysis and clustering process
 
 import factor_data as fdata
+import factor_screening as fscreen
 import datetime as dt
 import stock_data
 import matplotlib.pyplot as plt
@@ -8,7 +9,6 @@ import pandas as pd
 import seaborn as sns
 import importlib
 import numpy as np
-from scipy.stats import pearsonr
 import scipy.cluster.hierarchy as spc
 import matplotlib.pylab as pylab
 sns.set(style="white", context='paper')
@@ -99,12 +99,7 @@ plt.close('all')
 
 # Correlation
 def calculate_pvalues(df):
-    df = df.dropna()._get_numeric_data()
-    dfcols = pd.DataFrame(columns=df.columns)
-    pvalues = dfcols.transpose().join(dfcols, how='outer')
-    for r in df.columns:
-        for c in df.columns:
-            pvalues[r][c] = round(pearsonr(df[r], df[c])[1], 4)
+    pvalues = fscreen.correlation_tests(df)[2].round(4)
     return pvalues
 
 
@@ -131,9 +126,7 @@ p_values.round(2).to_csv('Output/all_factors_p_val.csv')
 # #### correlation clustering
 cluster_factors_ret = fdata.get_factors(['SMB', 'RMW', 'CMA', 'MOM', 'BaB', 'QMJ', 'HML_Devil', 'UMD'],
                                     start_date, end_date)
-pdist = spc.distance.pdist(cluster_factors_ret.T, metric='correlation')
-linkage = spc.linkage(pdist, method='complete')
-idx = spc.fcluster(linkage, 0.5 * pdist.max(), 'distance')
+idx, linkage, pdist = fscreen.cluster_factors(cluster_factors_ret, threshold=0.5, method='complete')
 spc.dendrogram(linkage, labels=cluster_factors_ret.columns)
 plt.title('Dendrogram of factor clusters (correlation as distance metric)')
 plt.savefig('Plots/cluster_corr.pdf')
@@ -151,9 +144,8 @@ D_mat.to_csv('Output/Distance_matrix.csv')
 
 
 # ## absolute correlation clustering insensitive
-pdist_abs = 1 - abs(-pdist + 1)
-linkage_abs = spc.linkage(pdist_abs, method='complete')
-idx_abs = spc.fcluster(linkage_abs, 0.5 * pdist_abs.max(), 'distance')
+idx_abs, linkage_abs, pdist_abs = fscreen.cluster_factors(cluster_factors_ret, threshold=0.5, method='complete',
+                                                          absolute=True)
 spc.dendrogram(linkage_abs, labels=cluster_factors_ret.columns)
 plt.title('Dendrograml of factor clusters (absolute correlation as distance metric)')
 plt.savefig('Plots/cluster_abs_corr.pdf')
@@ -9,17 +9,77 @@ from dateutil.relativedelta import relativedelta
 from alive_progress import alive_bar
 from alive_progress import config_handler
 import factor_risk_parity as frp
+from rolling_estimators import RollingLoadings
+import parallel_backtest
 
 config_handler.set_global(force_tty=True)
 
 
-def weights_factor_weight_parity(stocks, factor_structure, loadings_matrix, x0):
+def solve_factor_weight_parity(loadings_matrix, x0, weight_bounds=None, max_iter=50, tol=1e-12):
+    """ Dedicated quadratic programming solver for factor weight parity.
+
+    The exposures A'x = 1/k are reachable exactly in most universes (n >> k), so among the portfolios with
+    A'x = 1/k, sum(x) = 1 and bounded weights the one closest to x0 is found:
+        min 1/2 ||x - x0||^2  s.t.  E x = b, lower <= x <= upper,  with E = [A'; 1'], b = [1/k; 1]
+    Its solution is x(l) = clip(x0 + E'l, lower, upper), with l solving E x(l) = b by a semi-smooth Newton method
+    on the (k+1) multipliers, each step costing O(n k^2).
+
+    :param loadings_matrix: Factor to stocks loading matrix
+    :param x0: asset weights vector the solution is closest to
+    :param weight_bounds: (lower, upper) bounds of the asset weights, (-1/n, 1) if None
+    :param max_iter: maximum number of Newton iterations
+    :param tol: tolerance on the squared norm of E x - b
+    :return: asset weights vector and dict with 'fun' (squared residual), 'n_iter' and 'converged'
+    """
+    AT = np.asarray(loadings_matrix, dtype=np.float64).T
+    x0 = np.asarray(x0, dtype=np.float64)
+    n_factors, n_stocks = AT.shape
+    if weight_bounds is None:
+        weight_bounds = (-1 / n_stocks, 1)
+    lower, upper = weight_bounds
+
+    E = np.vstack([AT, np.ones(n_stocks)])
+    b = np.concatenate([np.full(n_factors, 1 / n_factors), [1]])
+
+    def weights(multipliers):
+        return np.clip(x0 + np.matmul(E.T, multipliers), lower, upper)
+
+    multipliers = np.zeros(n_factors + 1)
+    x = weights(multipliers)
+    residual = np.matmul(E, x) - b
+    f = np.dot(residual, residual)
+    n_iter = 0
+    while f > tol and n_iter < max_iter:
+        n_iter += 1
+        free = (x > lower) & (x < upper)
+        EDEt = np.matmul(E[:, free], E[:, free].T)
+        step = -np.linalg.lstsq(EDEt, residual, rcond=None)[0]
+        # backtracking on the residual norm
+        alpha = 1
+        while alpha > 1e-8:
+            x_new = weights(multipliers + alpha * step)
+            residual_new = np.matmul(E, x_new) - b
+            f_new = np.dot(residual_new, residual_new)
+            if f_new < f:
+                break
+            alpha /= 2
+        else:
+            break
+        multipliers, x, residual, f = multipliers + alpha * step, x_new, residual_new, f_new
+
+    return x, {'fun': f, 'n_iter': n_iter, 'converged': bool(f <= tol)}
+
+
+def weights_factor_weight_parity(stocks, factor_structure, loadings_matrix, x0, solver='slsqp', solver_options=None):
     """ Calculates assets weights according to the factor weight parity approach
 
     :param stocks: DataFrame of stock returns
     :param factor_structure: Structure of factor clusters (factors that share weight budgets)
     :param loadings_matrix: Factor to stocks loading matrix
     :param x0: asset weighs vector for initialization
+    :param solver: 'slsqp', or 'qp' for solve_factor_weight_parity with SLSQP as fallback when the target
+        exposures can not be reached within the bounds
+    :param solver_options: dict of max_iter and tol given to solve_factor_weight_parity
     :return: asset weights vector using factor risk parity method
     """
 
@@ -27,28 +87,70 @@ def weights_factor_weight_parity(stocks, factor_structure, loadings_matrix, x0):
     if x0 is None:
         x0 = np.ones(n_stocks) * 1 / n_stocks
 
-    def square(listt):
-        return [i ** 2 for i in listt]
+    if solver == 'qp':
+        x, info = solve_factor_weight_parity(loadings_matrix, x0, **(solver_options or {}))
+        if info['converged']:
+            return x
 
-    fun = lambda  x: sum(square(np.matmul(loadings_matrix.values.T, x) - 1 / loadings_matrix.shape[1]))
+    AT = loadings_matrix.values.T
+    target = 1 / loadings_matrix.shape[1]
 
-    # constrains
-    cons = [{'type': 'ineq', 'fun': lambda x: -sum(x) + 1},
-            {'type': 'ineq', 'fun': lambda x: sum(x) - 1},
+    def fun(x):
+        return np.sum((np.matmul(AT, x) - target) ** 2)
 
-            ]
+    def jac(x):
+        return 2 * np.matmul(AT.T, np.matmul(AT, x) - target)
+
+    # constrains
+    cons = [frp.budget_constraint(n_stocks)]
 
     # bounds
     bounds_short_lev = [(-1 / n_stocks, 1) for n in range(n_stocks)]
     bounds_long = [(0, 1) for n in range(n_stocks)]
     bounds = bounds_short_lev
 
-    res = minimize(fun, x0, method='SLSQP', bounds=bounds, constraints=cons, tol=1e-5, options={'disp': False})
+    res = minimize(fun, x0, jac=jac, method='SLSQP', bounds=bounds, constraints=cons, tol=1e-5,
+                   options={'disp': False})
     # print(res.fun)
     return res.x
 
 
-def portfolio_weights_factor_weight_parity(tickers, factor_tickers, start_date, end_date, portfolio_rebalance_period):
+def factor_weight_parity_on_date(t, x0, state, tickers, factor_tickers_flat, factor_structure, solver='slsqp'):
+    """ Factor weight parity weights of one rebalancing date, using the 12 months of returns up to the date
+
+    :param t: rebalancing date
+    :param x0: asset weights vector for initialization (None for equal weights)
+    :param state: dict kept between consecutive dates, holding the rolling loadings
+    :param tickers: List of tickers of all candidate stocks to the portfolio
+    :param factor_tickers_flat: List of tickers of factor used
+    :param factor_structure: Structure of factor clusters
+    :param solver: 'slsqp' or 'qp'
+    :return: asset weights vector
+    """
+    rolling_loadings = state.setdefault('rolling_loadings', RollingLoadings())
+
+    stocks = stock_data.get_daily_returns(tickers, t + relativedelta(months=-12), t)[1:]
+    factors = factor_data.get_factors(factor_tickers_flat, stocks.index[0], stocks.index[-1])
+    loadings_matrix = frp.get_loading_matrix(stocks, factors, rolling_loadings)
+    x = weights_factor_weight_parity(stocks, factor_structure, loadings_matrix, x0, solver)
+    print(np.matmul(loadings_matrix.T, x))
+
+    return x
+
+
+def factor_weight_parity_strategy(window, x0, solver='slsqp'):
+    """ Factor weight parity weights of a rebalance_pipeline.RebalanceWindow
+
+    :param window: RebalanceWindow of the rebalancing date
+    :param x0: asset weights vector for initialization (None for equal weights)
+    :param solver: 'slsqp' or 'qp'
+    :return: asset weights vector
+    """
+    return weights_factor_weight_parity(window.stocks, window.factor_structure, window.loadings_matrix, x0, solver)
+
+
+def portfolio_weights_factor_weight_parity(tickers, factor_tickers, start_date, end_date, portfolio_rebalance_period,
+                                           solver='slsqp', n_jobs=1, warm_start='chained'):
     """ Applies factor weight parity over a period of time. Can be used for back testing
 
     :param tickers: List of tickers of all candidate stocks to the portfolio
@@ -56,6 +158,9 @@ def portfolio_weights_factor_weight_parity(tickers, factor_tickers, start_date,
     :param start_date: first date of the investment period
     :param end_date: last date of the investment period
     :param portfolio_rebalance_period: portfolio re-balancing period (monthly, weekly, etc.)
+    :param solver: 'slsqp' or 'qp' (dedicated solver with SLSQP fallback)
+    :param n_jobs: number of processes, above 1 the dates are spread over a process pool (see parallel_backtest)
+    :param warm_start: with n_jobs above 1, 'chained' warm starts inside each block of dates or 'cold' starts
     :return: DataFrame of asset weight vectors for each portfolio reabalancing date
     """
     factor_structure = []
@@ -70,18 +175,18 @@ def portfolio_weights_factor_weight_parity(tickers, factor_tickers, start_date,
             factor_tickers_flat.append(group)
 
     business_days_end_months = pd.date_range(start_date, end_date, freq=portfolio_rebalance_period)
-    portfolio_weights = pd.DataFrame(index=business_days_end_months, columns=tickers)
+    args = (tickers, factor_tickers_flat, factor_structure, solver)
+    if n_jobs != 1:
+        return parallel_backtest.run_rebalance_dates(factor_weight_parity_on_date, business_days_end_months, tickers,
+                                                     args, n_jobs, warm_start)
+
+    portfolio_weights = pd.DataFrame(index=business_days_end_months, columns=tickers, dtype=np.float64)
     x0 = None
+    state = {}
     with alive_bar(len(business_days_end_months)) as bar:
         for t in business_days_end_months:
-            stocks = stock_data.get_daily_returns(tickers, t + relativedelta(months=-12), t)[1:]
-            factors = factor_data.get_factors(factor_tickers_flat, stocks.index[0], stocks.index[-1])
-            loadings_matrix = frp.get_loading_matrix(stocks, factors)
-            sigma = frp.big_sigma(stocks)
-            portfolio_weights.loc[t] = weights_factor_weight_parity(stocks, factor_structure, loadings_matrix, x0)
+            portfolio_weights.loc[t] = factor_weight_parity_on_date(t, x0, state, *args)
             x0 = portfolio_weights.loc[t]
-            print(np.matmul(loadings_matrix.T, x0))
             bar()
 
     return portfolio_weights
-
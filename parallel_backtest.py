@@ -0,0 +1,109 @@
+# parallel execution of the rebalancing dates of a back test over a pool of processes
+
+import os
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import stock_data
+import factor_data
+import risk_model_cache
+
+
+def rebalance_blocks(dates, n_blocks):
+    """ Splits the rebalancing dates into contiguous blocks of (almost) equal size
+
+    :param dates: rebalancing dates
+    :param n_blocks: number of blocks
+    :return: list of lists of dates
+    """
+    n_blocks = max(1, min(n_blocks, len(dates)))
+    return [[dates[i] for i in block] for block in np.array_split(np.arange(len(dates)), n_blocks) if len(block)]
+
+
+def run_block(weights_on_date, block, args, warm_start, spill_directory=None, x0=None):
+    """ Computes the weights of a block of consecutive rebalancing dates in one process
+
+    :param weights_on_date: function (t, x0, state, *args) returning the weights of date t; state is a dict kept
+        across the dates of the block (rolling estimators, ...)
+    :param block: list of consecutive rebalancing dates
+    :param args: extra arguments of weights_on_date
+    :param warm_start: 'chained' to start each date from the previous date's weights, 'cold' to start every date
+        from the default initialization
+    :param spill_directory: spill directory of the calling process' risk model cache (see risk_model_cache)
+    :param x0: weights of the date preceding the block, warm start of its first date (None to start cold)
+    :return: list of weight vectors
+    """
+    if spill_directory is not None:
+        risk_model_cache.configure_risk_model_cache(spill_directory=spill_directory)
+    state = {}
+    weights = []
+    for t in block:
+        x = np.asarray(weights_on_date(t, x0 if warm_start == 'chained' else None, state, *args), dtype=np.float64)
+        weights.append(x)
+        x0 = x
+
+    return weights
+
+
+def run_rebalance_dates(weights_on_date, dates, tickers, args=(), n_jobs=None, warm_start='chained',
+                        n_blocks=None, checkpoint=None):
+    """ Computes the portfolio weights of every rebalancing date over a pool of processes.
+
+    Dates are split into contiguous blocks, one task per block. Within a block the dates run in order, so the
+    rolling estimators are reused and, with chained warm starts, each date starts from the previous solution; the
+    first date of every block starts cold. Workers read prices and factors from the memory mapped compiled
+    caches (see stock_data.get_price_store and factor_data.get_factor_store), which are built here before the pool
+    starts, so the data panels are shared between processes instead of being pickled per task.
+    With a checkpoint, dates already completed are skipped and each block is recorded as soon as it is done, in
+    completion order, so a block that fails does not lose the blocks finished after it; a block following a
+    completed date is warm started from that date's weights. Only the returned DataFrame is in date order.
+    On Windows the calling script must be guarded by if __name__ == '__main__'.
+
+    :param weights_on_date: top level function (t, x0, state, *args) returning the weights of date t
+    :param dates: rebalancing dates
+    :param tickers: tickers of the weights (columns of the result)
+    :param args: extra arguments of weights_on_date
+    :param n_jobs: number of worker processes (os.cpu_count() if None)
+    :param warm_start: 'chained' (warm start inside each block) or 'cold' (every date from the default start)
+    :param n_blocks: number of blocks, n_jobs for chained warm starts and 4 * n_jobs for cold starts if None
+    :param checkpoint: optional backtest_checkpoint.BacktestCheckpoint of the back test
+    :return: DataFrame of asset weight vectors for each rebalancing date
+    """
+    if warm_start not in ('chained', 'cold'):
+        raise ValueError("warm_start must be 'chained' or 'cold'")
+    n_jobs = n_jobs or os.cpu_count()
+    if n_blocks is None:
+        n_blocks = n_jobs if warm_start == 'chained' else 4 * n_jobs
+    dates = list(dates)
+    completed = {} if checkpoint is None else checkpoint.load()
+    blocks = rebalance_blocks([t for t in dates if pd.Timestamp(t) not in completed], n_blocks)
+    previous = dict(zip((pd.Timestamp(t) for t in dates[1:]), (pd.Timestamp(t) for t in dates[:-1])))
+
+    # compile the shared caches once, before the workers map them
+    stock_data.get_price_store()
+    factor_data.get_factor_store()
+
+    # risk models estimated by the workers reach the calling process through the cache's spill directory
+    spill_directory = risk_model_cache.get_risk_model_cache().spill_directory
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        futures = {}
+        for block in blocks:
+            x0 = completed.get(previous.get(pd.Timestamp(block[0])))
+            futures[executor.submit(run_block, weights_on_date, block, args, warm_start, spill_directory,
+                                    x0 if warm_start == 'chained' else None)] = block
+        error = None
+        for future in as_completed(futures):
+            try:
+                weights = future.result()
+            except Exception as e:
+                # the other blocks are still recorded, the first error is raised once they are done
+                error = error or e
+                continue
+            for t, x in zip(futures[future], weights):
+                completed[pd.Timestamp(t)] = x
+                if checkpoint is not None:
+                    checkpoint.append(t, x)
+        if error is not None:
+            raise error
+
+    return pd.DataFrame(np.vstack([completed[pd.Timestamp(t)] for t in dates]), index=dates, columns=tickers)
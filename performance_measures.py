@@ -9,7 +9,9 @@ import numpy as np
 import factor_data
 import stock_data
 from dateutil.relativedelta import relativedelta
-from factor_risk_parity import get_loading_matrix, get_risk_contributions, big_sigma
+from factor_risk_parity import get_loading_matrix, big_sigma, FactorRiskModel
+from rolling_estimators import RollingCovariance, RollingLoadings
+from risk_model_cache import get_risk_model_cache
 from alive_progress import alive_bar
 from alive_progress import config_handler
 config_handler.set_global(force_tty=True)
@@ -17,22 +19,104 @@ config_handler.set_global(force_tty=True)
 
 def performance_measures(portfolio_daily_returns, benchmark_returns=None, var_probability=0.05):
     # return pandas of all measures
-    measures = {'Annualized Returns (CAGR) (%)': annual_returns_cagr(portfolio_daily_returns)*100,
-                'Cumulative Returns (%)': cumulative_returns(portfolio_daily_returns)*100,
-                'Annualized Volatility (%)': annual_volatility(portfolio_daily_returns)*100,
-                'Sharpe Ratio': sharpe_ratio(portfolio_daily_returns),
-                'Max Drawdown (%)': max_drawdown(portfolio_daily_returns)*100,
-                'Calmar Ratio': calmar_ratio(portfolio_daily_returns),
-                'Stability': stability(portfolio_daily_returns),
-                'Skewness': skewness(portfolio_daily_returns),
-                'Kurtosis': kurtosis(portfolio_daily_returns),
-                'Daily Value at Risk (VaR) (%)': value_at_risk(portfolio_daily_returns, var_probability)*100,
-                'Expected Shortfall (%)': expected_shortfall(portfolio_daily_returns, var_probability)*100,
-                'Tail Ratio': tail_ratio(portfolio_daily_returns),
-                'Alpha': alpha(portfolio_daily_returns, benchmark_returns),
-                'Beta': beta(portfolio_daily_returns, benchmark_returns)
+    measures = performance_measures_table(portfolio_daily_returns.to_frame(), benchmark_returns, var_probability)
+    return measures.iloc[:, 0].rename(None)
+
+
+def performance_measures_table(portfolios_daily_returns, benchmark_returns=None, var_probability=0.05,
+                               annualization=252):
+    """ Performance measures of many portfolios at once, same measures as empyrical for each column.
+
+    All columns are evaluated together on arrays, sharing one cumulative product (cumulative returns, CAGR and
+    drawdown), one sort (VaR, expected shortfall and tail ratio) and one alignment with the benchmark (alpha and
+    beta). Missing values of a column are left out, as if each column had been passed alone without them.
+
+    :param portfolios_daily_returns: DataFrame of daily returns, one column per portfolio
+    :param benchmark_returns: daily returns of the benchmark (Series or one column DataFrame), S&P 500 if None
+    :param var_probability: probability of the Value at Risk and Expected Shortfall
+    :param annualization: number of return periods in a year
+    :return: DataFrame of measures (rows) for each portfolio (columns)
+    """
+    returns = np.asarray(portfolios_daily_returns.values, dtype=np.float64)
+    valid = ~np.isnan(returns)
+    n = valid.sum(axis=0)
+    r = np.where(valid, returns, 0)
+
+    mean = r.sum(axis=0) / n
+    centered = np.where(valid, returns - mean, 0)
+    m2 = (centered ** 2).sum(axis=0) / n
+    std = np.sqrt(m2 * n / (n - 1))
+
+    # one cumulative product: cumulative returns, CAGR and drawdowns
+    wealth = np.cumprod(np.vstack([np.ones(r.shape[1]), 1 + r]), axis=0)
+    cum_returns = wealth[-1] - 1
+    cagr = wealth[-1] ** (annualization / n) - 1
+    drawdowns = wealth / np.maximum.accumulate(wealth, axis=0) - 1
+    max_dd = drawdowns.min(axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        calmar = np.where(max_dd < 0, cagr / np.abs(max_dd), np.nan)
+
+    # stability: R^2 of the cumulated log returns against time
+    log_wealth = np.where(valid, np.cumsum(np.log1p(r), axis=0), 0)
+    time = np.where(valid, np.cumsum(valid, axis=0) - 1, 0)
+    time_centered = np.where(valid, time - time.sum(axis=0) / n, 0)
+    log_centered = np.where(valid, log_wealth - log_wealth.sum(axis=0) / n, 0)
+    stability = (time_centered * log_centered).sum(axis=0) ** 2 / \
+        ((time_centered ** 2).sum(axis=0) * (log_centered ** 2).sum(axis=0))
+
+    # one sort (missing values last): VaR, expected shortfall and tail ratio
+    sorted_returns = np.sort(returns, axis=0)
+    cum_sorted = np.cumsum(np.where(np.isnan(sorted_returns), 0, sorted_returns), axis=0)
+
+    def var_es(probability):
+        position = (n - 1) * probability
+        lower = np.floor(position).astype(int)
+        upper = np.minimum(lower + 1, n - 1)
+        columns = np.arange(r.shape[1])
+        value_ar = sorted_returns[lower, columns] + (position - lower) * \
+            (sorted_returns[upper, columns] - sorted_returns[lower, columns])
+        cutoff = ((n - 1) * probability).astype(int)
+        return value_ar, cum_sorted[cutoff, columns] / (cutoff + 1)
+
+    value_ar, cvar = var_es(var_probability)
+    # the tail ratio is measured on the 5% tail, as tail_ratio
+    tail_var, tail_cvar = (value_ar, cvar) if var_probability == 0.05 else var_es(0.05)
+    tail = sorted_returns <= tail_var
+    tail_risk = np.sqrt(np.where(tail, (sorted_returns - tail_cvar) ** 2, 0).sum(axis=0) / tail.sum(axis=0))
+    tail_ratio = cagr / (tail_risk * np.sqrt(annualization))
+
+    # one benchmark alignment: alpha and beta over the days with both returns
+    if benchmark_returns is None:
+        benchmark_returns = sdata.get_sp500_index_returns(portfolios_daily_returns.index.min(),
+                                                          portfolios_daily_returns.index.max())
+    if isinstance(benchmark_returns, pd.DataFrame):
+        benchmark_returns = benchmark_returns.iloc[:, 0]
+    benchmark = benchmark_returns.reindex(portfolios_daily_returns.index).values.astype(np.float64)
+    both = valid & ~np.isnan(benchmark)[:, None]
+    n_both = both.sum(axis=0)
+    b = np.where(both, benchmark[:, None], 0)
+    b_centered = np.where(both, b - b.sum(axis=0) / n_both, 0)
+    b_variance = (b_centered ** 2).sum(axis=0) / n_both
+    b_variance[b_variance < 1.0e-30] = np.nan
+    beta = (b_centered * np.where(both, r, 0)).sum(axis=0) / n_both / b_variance
+    alpha = (np.where(both, r - beta * b, 0).sum(axis=0) / n_both + 1) ** annualization - 1
+
+    measures = {'Annualized Returns (CAGR) (%)': cagr * 100,
+                'Cumulative Returns (%)': cum_returns * 100,
+                'Annualized Volatility (%)': std * np.sqrt(annualization) * 100,
+                'Sharpe Ratio': mean / std * np.sqrt(annualization),
+                'Max Drawdown (%)': max_dd * 100,
+                'Calmar Ratio': calmar,
+                'Stability': stability,
+                'Skewness': (centered ** 3).sum(axis=0) / n / m2 ** 1.5,
+                'Kurtosis': (centered ** 4).sum(axis=0) / n / m2 ** 2 - 3,
+                'Daily Value at Risk (VaR) (%)': value_ar * 100,
+                'Expected Shortfall (%)': cvar * 100,
+                'Tail Ratio': tail_ratio,
+                'Alpha': alpha,
+                'Beta': beta
                 }
-    return pd.Series(measures)
+    return pd.DataFrame(measures, index=portfolios_daily_returns.columns).T
 
 
 def annual_returns_cagr(portfolio_daily_returns):
@@ -89,13 +173,8 @@ def tail_ratio(portfolio_daily_returns, probability=0.05, risk_free=0):
     #return ep.tail_ratio(portfolio_daily_returns)
     value_ar = value_at_risk(portfolio_daily_returns)
     cvar = expected_shortfall(portfolio_daily_returns)
-    sum_r = 0
-    count = 0
-    for r in portfolio_daily_returns:
-        if r <= value_ar:
-            sum_r += (r - cvar) ** 2
-            count += 1
-    tail_risk = np.sqrt(sum_r / count)
+    returns = np.asarray(portfolio_daily_returns, dtype=np.float64)
+    tail_risk = np.sqrt(np.mean((returns[returns <= value_ar] - cvar) ** 2))
 
     cagr = annual_returns_cagr(portfolio_daily_returns)
     tail_ratio = (cagr - risk_free) / (tail_risk*np.sqrt(252))
@@ -115,14 +194,24 @@ def factor_exposures_and_risk_contributions(x, factor_tickers):
     f_exposures = pd.DataFrame([])
     exposures = []
     rc = []
+    rolling_covariance = RollingCovariance()
+    rolling_loadings = RollingLoadings()
+    # risk models already estimated by the portfolio construction are reused
+    cache = get_risk_model_cache()
     with alive_bar(len(x.index)) as bar:
         for t in x.index:
-            stock_returns = stock_data.get_daily_returns(stock_tickers, t + relativedelta(months=-12), t)[1:]
-            factor_returns = factor_data.get_factors(factor_tickers, stock_returns.index[0], stock_returns.index[-1])
-            l_mat = get_loading_matrix(stock_returns, factor_returns)
-            exposures.append(np.matmul(l_mat.T, x.loc[t]))
-            sigma = big_sigma(stock_returns)
-            rc.append(get_risk_contributions(x.loc[t], l_mat, sigma))
+            key = cache.key(stock_tickers, factor_tickers, t, 12, 'sample')
+            risk_model = cache.get(key)
+            if risk_model is None:
+                stock_returns = stock_data.get_daily_returns(stock_tickers, t + relativedelta(months=-12), t)[1:]
+                factor_returns = factor_data.get_factors(factor_tickers, stock_returns.index[0],
+                                                         stock_returns.index[-1])
+                l_mat = get_loading_matrix(stock_returns, factor_returns, rolling_loadings)
+                sigma = big_sigma(stock_returns, rolling_covariance)
+                risk_model = FactorRiskModel(l_mat, sigma)
+                cache.put(key, risk_model)
+            exposures.append(np.matmul(risk_model.loadings_matrix.T, x.loc[t]))
+            rc.append(risk_model.risk_contributions(x.loc[t]))
             bar()
     return pd.DataFrame(exposures), pd.DataFrame(rc, index=x.index, columns=factor_tickers)
 
@@ -0,0 +1,116 @@
+# single pass over the rebalancing dates feeding the same risk inputs to several portfolio construction strategies
+
+import numpy as np
+import pandas as pd
+from dateutil.relativedelta import relativedelta
+import stock_data
+import factor_data
+from factor_risk_parity import get_loading_matrix, get_risk_model, big_sigma, FactorRiskModel, split_factor_tickers
+from rolling_estimators import RollingCovariance, RollingLoadings
+from alive_progress import alive_bar
+from alive_progress import config_handler
+config_handler.set_global(force_tty=True)
+
+
+class RebalanceWindow:
+    """ Risk inputs of one rebalancing date: the returns window and, computed on first use only, the aligned factors,
+    the loadings matrix, the covariance matrix and the factor risk model
+    """
+
+    def __init__(self, date, tickers, stocks, n_prices, factor_tickers_flat, factor_structure, estimators,
+                 covariance_model='sample'):
+        """
+        :param date: rebalancing date
+        :param tickers: List of tickers of the stocks
+        :param stocks: DataFrame of stock returns of the window
+        :param n_prices: number of price observations of the window (scaling of the risk parity covariance)
+        :param factor_tickers_flat: List of tickers of factor used
+        :param factor_structure: Structure of factor clusters
+        :param estimators: dict of the rolling estimators shared by consecutive windows
+        :param covariance_model: 'sample' or 'factor', see factor_risk_parity.get_risk_model
+        """
+        self.date = date
+        self.tickers = tickers
+        self.stocks = stocks
+        self.n_prices = n_prices
+        self.factor_tickers_flat = factor_tickers_flat
+        self.factor_structure = factor_structure
+        self.covariance_model = covariance_model
+        self._estimators = estimators
+        self._factors = None
+        self._loadings_matrix = None
+        self._sigma = None
+        self._risk_model = None
+
+    @property
+    def factors(self):
+        """ DataFrame of factor returns over the dates of the returns window """
+        if self._factors is None:
+            self._factors = factor_data.get_factors(self.factor_tickers_flat, self.stocks.index[0],
+                                                    self.stocks.index[-1])
+        return self._factors
+
+    @property
+    def loadings_matrix(self):
+        """ Factor to stocks loading matrix """
+        if self._loadings_matrix is None:
+            self._loadings_matrix = get_loading_matrix(self.stocks, self.factors, self._estimators['loadings'])
+        return self._loadings_matrix
+
+    @property
+    def sigma(self):
+        """ Sample covariance matrix of the stock returns """
+        if self._sigma is None:
+            self._sigma = big_sigma(self.stocks, self._estimators['covariance'])
+        return self._sigma
+
+    @property
+    def risk_model(self):
+        """ Factor risk model of the window (sample or structured covariance) """
+        if self._risk_model is None:
+            if self.covariance_model == 'sample':
+                self._risk_model = FactorRiskModel(self.loadings_matrix, self.sigma)
+            else:
+                self._risk_model = get_risk_model(self.stocks, self.factors, self.loadings_matrix,
+                                                  self.covariance_model)[1]
+        return self._risk_model
+
+
+def run_strategies(tickers, factor_tickers, start_date, end_date, portfolio_rebalance_period, strategies,
+                   lookback_months=12, covariance_model='sample'):
+    """ Runs several portfolio construction strategies in a single pass over the rebalancing dates.
+
+    The returns window of each date is sliced once and its factors, loadings and covariance are computed at most
+    once, on the first strategy needing them, then handed to every strategy.
+
+    :param tickers: List of tickers of all candidate stocks to the portfolio
+    :param factor_tickers: List of tickers of factor used and respective cluster format
+    :param start_date: first date of the investment period
+    :param end_date: last date of the investment period
+    :param portfolio_rebalance_period: portfolio re-balancing period (monthly, weekly, etc.)
+    :param strategies: dict of strategy name to function (window, x0) returning the weights of a RebalanceWindow,
+        x0 being the strategy's previous weights (None on the first date), e.g.
+        {'EW': equal_weight.ew_strategy, 'RP': risk_parity.risk_parity_strategy,
+         'FRP': factor_risk_parity.factor_risk_parity_strategy, 'FWP': factor_weight_parity.factor_weight_parity_strategy}
+    :param lookback_months: length of the estimation window in months
+    :param covariance_model: 'sample' or 'factor', see factor_risk_parity.get_risk_model
+    :return: dict of strategy name to DataFrame of asset weight vectors for each portfolio rebalancing date
+    """
+    factor_tickers_flat, factor_structure = split_factor_tickers(factor_tickers)
+    business_days_end_months = pd.date_range(start_date, end_date, freq=portfolio_rebalance_period)
+    price_store = stock_data.get_price_store()
+    estimators = {'covariance': RollingCovariance(), 'loadings': RollingLoadings()}
+
+    weights = {name: np.empty((len(business_days_end_months), len(tickers))) for name in strategies}
+    with alive_bar(len(business_days_end_months)) as bar:
+        for i, t in enumerate(business_days_end_months):
+            window_start = t + relativedelta(months=-lookback_months)
+            stocks = stock_data.get_daily_returns(tickers, window_start, t)[1:]
+            rows = price_store.rows(window_start, t)
+            window = RebalanceWindow(t, tickers, stocks, rows.stop - rows.start, factor_tickers_flat,
+                                     factor_structure, estimators, covariance_model)
+            for name, strategy in strategies.items():
+                weights[name][i] = strategy(window, weights[name][i - 1] if i > 0 else None)
+            bar()
+
+    return {name: pd.DataFrame(w, index=business_days_end_months, columns=tickers) for name, w in weights.items()}
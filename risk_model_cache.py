@@ -0,0 +1,178 @@
+# per rebalancing date risk models, shared between portfolio construction and performance attribution
+
+import os
+import json
+import hashlib
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+import data_cache
+import stock_data
+import factor_data
+
+# risk models held in memory by default, a dense n x n covariance matrix each
+DEFAULT_MAX_ENTRIES = 12
+# directory where the shared cache writes every risk model by default, so that the attribution of a back test reads
+# back the risk models of all its dates (compiled data caches are kept out of git, as *_cache directories)
+DEFAULT_SPILL_DIRECTORY = r'Data\risk_models_cache'
+
+
+def universe_hash(tickers):
+    """ SHA-1 of an ordered list of tickers
+
+    :param tickers: List of tickers
+    :return: hexadecimal digest
+    """
+    return hashlib.sha1('\x1f'.join(str(ticker) for ticker in tickers).encode()).hexdigest()
+
+
+def data_hash(factor_tickers=()):
+    """ Hash of the data the risk models are estimated from: contents of the price and factor files and definitions
+    of the composite factors used
+
+    :param factor_tickers: flat List of tickers of the factors
+    :return: hexadecimal digest
+    """
+    factor_store = factor_data.get_factor_store()
+    definitions = {f: factor_store.composites[f] for f in factor_tickers if f in factor_store.composites}
+    return universe_hash([stock_data.get_price_store().source_hash, factor_store.source_hash,
+                          json.dumps(definitions, sort_keys=True)])
+
+
+class RiskModelCache:
+    """ Risk models (loadings, covariance and pseudo-inverse) of rebalancing dates, keyed by the stock universe,
+    the factors, the end and length of the estimation window and the covariance model.
+
+    Entries live in memory, the least recently used being dropped above max_entries. With a spill directory every
+    entry is also written to disk, so entries dropped from memory, or computed by another process or an earlier
+    run, are read back instead of being estimated again. Keys include the hash of the price and factor data, so
+    entries estimated from older data are not served after the data files change.
+    """
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, spill_directory=None):
+        """
+        :param max_entries: maximum number of risk models held in memory (None for no limit)
+        :param spill_directory: directory where entries are written to and read back from (None for memory only)
+        """
+        self.max_entries = max_entries
+        self.spill_directory = spill_directory
+        self._entries = OrderedDict()
+
+    @staticmethod
+    def key(tickers, factor_tickers, window_end, lookback_months, covariance_model='sample', data=None):
+        """ Key of the risk model of one rebalancing date
+
+        :param tickers: List of tickers of the stocks
+        :param factor_tickers: flat List of tickers of the factors
+        :param window_end: last date of the estimation window (rebalancing date)
+        :param lookback_months: length of the estimation window in months
+        :param covariance_model: 'sample' or 'factor', see factor_risk_parity.get_risk_model
+        :param data: hash of the data, see data_hash (of the current price and factor data if None)
+        :return: hashable key
+        """
+        return (universe_hash(tickers), tuple(factor_tickers), pd.Timestamp(window_end).strftime('%Y%m%d'),
+                int(lookback_months), covariance_model, data_hash(factor_tickers) if data is None else data)
+
+    def _spill_path(self, key):
+        name = hashlib.sha1(repr(key).encode()).hexdigest() + '.npz'
+        return os.path.join(self.spill_directory, name)
+
+    def get(self, key):
+        """ Risk model of a key
+
+        :param key: key given by RiskModelCache.key
+        :return: FactorRiskModel (or StructuredFactorRiskModel), None when not cached
+        """
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            return self._entries[key]
+        if self.spill_directory is not None and os.path.exists(self._spill_path(key)):
+            risk_model = _load_risk_model(self._spill_path(key))
+            if risk_model is not None:
+                self._hold(key, risk_model)
+            return risk_model
+        return None
+
+    def put(self, key, risk_model):
+        """ Stores the risk model of a key
+
+        :param key: key given by RiskModelCache.key
+        :param risk_model: FactorRiskModel (or StructuredFactorRiskModel)
+        """
+        self._hold(key, risk_model)
+        if self.spill_directory is not None:
+            try:
+                os.makedirs(self.spill_directory, exist_ok=True)
+                _save_risk_model(self._spill_path(key), risk_model)
+            except OSError:
+                # spill is best effort, the entry is still held in memory
+                pass
+
+    def _hold(self, key, risk_model):
+        self._entries[key] = risk_model
+        self._entries.move_to_end(key)
+        if self.max_entries is not None:
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """ Forgets the entries held in memory (spilled entries are kept) """
+        self._entries.clear()
+
+
+def _save_risk_model(path, risk_model):
+    arrays = {'stocks': np.asarray(risk_model.loadings_matrix.index, dtype=str),
+              'factors': np.asarray(risk_model.loadings_matrix.columns, dtype=str),
+              'A': risk_model.A, 'Aplus': risk_model.Aplus}
+    if risk_model.Sigma is None:
+        arrays.update(F=risk_model.F, D=risk_model.D)
+    else:
+        arrays.update(Sigma=np.asarray(risk_model.Sigma, dtype=np.float64))
+    data_cache.write_atomic(path, lambda f: np.savez(f, **arrays))
+
+
+def _load_risk_model(path):
+    # imported here, factor_risk_parity itself uses the cache
+    from factor_risk_parity import FactorRiskModel, StructuredFactorRiskModel
+
+    try:
+        with np.load(path, allow_pickle=False) as arrays:
+            loadings_matrix = pd.DataFrame(arrays['A'], index=arrays['stocks'], columns=arrays['factors'])
+            if 'Sigma' in arrays.files:
+                return FactorRiskModel(loadings_matrix, arrays['Sigma'], arrays['Aplus'])
+            return StructuredFactorRiskModel(loadings_matrix, arrays['F'], arrays['D'], arrays['Aplus'])
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+_risk_model_cache = RiskModelCache(spill_directory=DEFAULT_SPILL_DIRECTORY)
+
+
+def get_risk_model_cache():
+    """ Risk model cache shared by the portfolio construction and the performance attribution of this process.
+    By default it holds the last DEFAULT_MAX_ENTRIES risk models in memory and writes every risk model to
+    DEFAULT_SPILL_DIRECTORY, so the attribution after a back test (performance_measures.
+    factor_exposures_and_risk_contributions) reads the risk models of all the dates back instead of estimating
+    them again, including those of parallel back tests and of earlier runs on the same data. See
+    configure_risk_model_cache to change it.
+
+    :return: RiskModelCache
+    """
+    return _risk_model_cache
+
+
+def configure_risk_model_cache(max_entries=DEFAULT_MAX_ENTRIES, spill_directory=DEFAULT_SPILL_DIRECTORY):
+    """ Replaces the shared risk model cache. Worker processes of parallel back tests hold their own memory, so
+    their entries only reach the calling process through the spill directory. Entries of older data stay in the
+    spill directory (keys include the data hashes, they are never served) until it is deleted, which can be done
+    at any time.
+
+    :param max_entries: maximum number of risk models held in memory (None for no limit)
+    :param spill_directory: directory where entries are written to and read back from (None for memory only, then
+        only the last max_entries risk models of a back test are reused by its attribution)
+    :return: the new RiskModelCache
+    """
+    global _risk_model_cache
+    _risk_model_cache = RiskModelCache(max_entries, spill_directory)
+
+    return _risk_model_cache
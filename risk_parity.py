@@ -1,29 +1,186 @@
+import warnings
 import numpy as np
 import pandas as pd
-import riskparityportfolio as rp
 from dateutil.relativedelta import relativedelta
 import stock_data
+from rolling_estimators import RollingCovariance
+import parallel_backtest
 from alive_progress import alive_bar
 from alive_progress import config_handler
 config_handler.set_global(force_tty=True)
 
 
-def weights_risk_parity(tickers, start_date, end_date):
+def solve_risk_parity(covariances, budgets=None, x0=None, tol=1e-10, max_iter=50):
+    """ Risk parity weights of a stack of covariance matrices, solved together by Newton's method.
+
+    Each date minimizes the vanilla risk parity objective 0.5 x' Sigma x - b' log(x) (as riskparityportfolio.vanilla),
+    whose minimum has risk contributions x_i (Sigma x)_i equal to the budgets b. The Newton systems of all the dates
+    are solved with one stacked call, with the damped step 1 / (1 + decrement) of self-concordant functions far from
+    the minimum (Spinu) so the weights stay positive. Dates whose largest risk contribution error is below tol are no
+    longer updated. A singular covariance matrix (fewer returns than assets in the window) with a null vector of
+    positive weights leaves the objective without minimum, such dates are reported as not converged.
+
+    :param covariances: 3-D array of covariance matrices (dates x assets x assets)
+    :param budgets: risk budgets (assets or dates x assets), parity if None
+    :param x0: starting weights (assets or dates x assets), e.g. the weights of the previous date; inverse volatility
+        weights if None
+    :param tol: tolerance on the largest absolute difference between the relative risk contributions and the budgets
+    :param max_iter: maximum number of Newton iterations
+    :return: weights (dates x assets, summing to 1) and DataFrame of the number of iterations, the final error and
+        the convergence of each date
+    """
+    covariances = np.asarray(covariances, dtype=np.float64)
+    n_dates, n_assets = covariances.shape[:2]
+    diagonal = (slice(None), np.arange(n_assets), np.arange(n_assets))
+    b = np.broadcast_to(np.full(n_assets, 1 / n_assets) if budgets is None else budgets, (n_dates, n_assets))
+    b = b / b.sum(axis=1, keepdims=True)
+    x = np.broadcast_to(1 / np.sqrt(covariances[diagonal]) if x0 is None else np.asarray(x0, dtype=np.float64),
+                        (n_dates, n_assets))
+    x = np.maximum(x, 1e-12 * x.max(axis=1, keepdims=True))
+    # scaled to the minimum of the objective along x, where x' Sigma x = sum(b) = 1
+    x = x / np.sqrt(np.einsum('ti,tij,tj->t', x, covariances, x))[:, None]
+
+    iterations = np.zeros(n_dates, dtype=int)
+    error = np.empty(n_dates)
+    active = np.arange(n_dates)
+    stack = covariances
+    while True:
+        sigma_x = np.einsum('tij,tj->ti', stack, x[active])
+        risk = x[active] * sigma_x
+        error[active] = np.abs(risk / risk.sum(axis=1, keepdims=True) - b[active]).max(axis=1)
+        keep = (error[active] > tol) & (iterations[active] < max_iter)
+        if not keep.any():
+            break
+        if not keep.all():
+            active, stack, sigma_x = active[keep], stack[keep], sigma_x[keep]
+
+        x_active = x[active]
+        b_active = b[active]
+        gradient = sigma_x - b_active / x_active
+        hessian = stack.copy()
+        hessian[diagonal] += b_active / x_active ** 2
+        step = np.linalg.solve(hessian, -gradient[..., None])[..., 0]
+        decrement = np.sqrt(np.maximum(-np.einsum('ti,ti->t', gradient, step), 0))
+        damping = np.where(decrement > 0.25, 1 / (1 + decrement), 1)
+        x[active] = x_active + damping[:, None] * step
+        iterations[active] += 1
+
+    convergence = pd.DataFrame({'Iterations': iterations, 'Error': error, 'Converged': error <= tol})
+    return x / x.sum(axis=1, keepdims=True), convergence
+
+
+def warn_not_converged(convergence):
+    """ Warns about the dates of a solve_risk_parity convergence DataFrame that did not converge
+
+    :param convergence: DataFrame of the convergence of each date, as returned by solve_risk_parity
+    """
+    not_converged = convergence[~convergence['Converged']]
+    if len(not_converged):
+        warnings.warn('Risk parity not converged for {} date(s):\n{}'.format(len(not_converged),
+                                                                           not_converged.to_string()))
+
+
+def weights_risk_parity(tickers, start_date, end_date, rolling_covariance=None, x0=None):
     prices = stock_data.get_prices(tickers, start_date, end_date)
-    cov_matrix = stock_data.get_covariance_matrix(prices)
-    budget = np.full(len(tickers), 1 / len(tickers))  # parity of risk budget
-    w = rp.vanilla.design(cov_matrix, budget)
+    cov_matrix = stock_data.get_covariance_matrix(prices, rolling_covariance)
+    weights, convergence = solve_risk_parity(cov_matrix[None], x0=x0)  # parity of risk budget
+    warn_not_converged(convergence.set_index(pd.Index([pd.Timestamp(end_date)])))
+    w = weights[0]
 
     return w
 
 
-def portfolio_weights_risk_parity(tickers, start_date, end_date, portfolio_rebalance_period):
+def risk_parity_on_date(t, x0, state, tickers):
+    """ Risk parity weights of one rebalancing date, using the 12 months of prices up to the date
+
+    :param t: rebalancing date
+    :param x0: previous rebalancing date's weights, starting point of the solver (None for inverse volatility)
+    :param state: dict kept between consecutive dates, holding the rolling covariance
+    :param tickers: List of tickers of all candidate stocks to the portfolio
+    :return: asset weights vector
+    """
+    rolling_covariance = state.setdefault('rolling_covariance', RollingCovariance())
+
+    return weights_risk_parity(tickers, t + relativedelta(months=-12), t, rolling_covariance, x0)
+
+
+def risk_parity_strategy(window, x0):
+    """ Risk parity weights of a rebalance_pipeline.RebalanceWindow
+
+    :param window: RebalanceWindow of the rebalancing date
+    :param x0: previous weights of the strategy, starting point of the solver (None for inverse volatility)
+    :return: asset weights vector
+    """
+    # same scaling as stock_data.get_covariance_matrix
+    cov_matrix = window.n_prices * window.sigma
+    weights, convergence = solve_risk_parity(cov_matrix[None], x0=x0)  # parity of risk budget
+    warn_not_converged(convergence)
+
+    return weights[0]
+
+
+def portfolio_weights_risk_parity_batch(tickers, start_date, end_date, portfolio_rebalance_period, batch_size=12,
+                                        tol=1e-10):
+    """ Risk parity weights of the rebalancing dates, solved by batches of consecutive dates (see solve_risk_parity).
+    All the dates of a batch start from the weights of the last date of the previous batch, so only the first date
+    of each batch is warm started from the date before it (1 date in 12 with batch_size=12); with batch_size=1 every
+    date starts from the previous date's weights. Dates that did not converge are warned about.
+
+    :param tickers: List of tickers of all candidate stocks to the portfolio
+    :param start_date: first date of the investment period
+    :param end_date: last date of the investment period
+    :param portfolio_rebalance_period: portfolio re-balancing period (monthly, weekly, etc.)
+    :param batch_size: number of dates solved together (a batch holds batch_size covariance matrices in memory)
+    :param tol: tolerance on the risk contribution errors, see solve_risk_parity
+    :return: DataFrame of asset weights and DataFrame of the convergence (iterations, error) of each rebalancing date
+    """
     business_days_end_months = pd.date_range(start_date, end_date, freq=portfolio_rebalance_period)
-    portfolio_weights = pd.DataFrame(index=business_days_end_months, columns=tickers)
+    weights = np.empty((len(business_days_end_months), len(tickers)))
+    convergence = []
+    rolling_covariance = RollingCovariance()
+    x0 = None
 
     with alive_bar(len(business_days_end_months)) as bar:
-        for t in business_days_end_months:
-            portfolio_weights.loc[t] = weights_risk_parity(tickers, t + relativedelta(months=-12), t)
-            bar()
+        for first in range(0, len(business_days_end_months), batch_size):
+            batch = business_days_end_months[first:first + batch_size]
+            covariances = np.empty((len(batch), len(tickers), len(tickers)))
+            for i, t in enumerate(batch):
+                prices = stock_data.get_prices(tickers, t + relativedelta(months=-12), t)
+                covariances[i] = stock_data.get_covariance_matrix(prices, rolling_covariance)
+            weights[first:first + len(batch)], batch_convergence = solve_risk_parity(covariances, x0=x0, tol=tol)
+            convergence.append(batch_convergence.set_index(batch))
+            # an unconverged solution is a poor starting point for the next batch
+            x0 = weights[first + len(batch) - 1] if batch_convergence['Converged'].iloc[-1] else None
+            for _ in batch:
+                bar()
+    convergence = pd.concat(convergence)
+    warn_not_converged(convergence)
+
+    return pd.DataFrame(weights, index=business_days_end_months, columns=tickers), convergence
+
+
+def portfolio_weights_risk_parity(tickers, start_date, end_date, portfolio_rebalance_period, n_jobs=1,
+                                  batch_size=12):
+    """ Risk parity weights of the rebalancing dates. Dates whose solve did not converge are warned about, see
+    portfolio_weights_risk_parity_batch for the convergence of each date.
+
+    With n_jobs=1 the dates are solved by batches of batch_size dates (portfolio_weights_risk_parity_batch): every
+    date of a batch starts from the last weights of the previous batch, so with the default batch_size=12 only 1 date
+    in 12 is warm started from the date before it. Use batch_size=1 to warm start every date from the previous one.
+    With n_jobs != 1 the dates run over a pool of processes (see parallel_backtest.run_rebalance_dates).
+
+    :param tickers: List of tickers of all candidate stocks to the portfolio
+    :param start_date: first date of the investment period
+    :param end_date: last date of the investment period
+    :param portfolio_rebalance_period: portfolio re-balancing period (monthly, weekly, etc.)
+    :param n_jobs: number of worker processes, 1 to solve the dates by batches in this process
+    :param batch_size: number of dates solved together when n_jobs=1
+    :return: DataFrame of asset weight vectors for each rebalancing date
+    """
+    business_days_end_months = pd.date_range(start_date, end_date, freq=portfolio_rebalance_period)
+    if n_jobs != 1:
+        return parallel_backtest.run_rebalance_dates(risk_parity_on_date, business_days_end_months, tickers,
+                                                     (tickers,), n_jobs)
 
-    return portfolio_weights
+    return portfolio_weights_risk_parity_batch(tickers, start_date, end_date, portfolio_rebalance_period,
+                                               batch_size)[0]
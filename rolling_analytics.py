@@ -0,0 +1,176 @@
+# rolling performance measures of many portfolios, in O(n) per series
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+import stock_data as sdata
+
+
+def _as_frame(returns):
+    if isinstance(returns, pd.Series):
+        return returns.to_frame(), True
+    return returns, False
+
+
+def _as_input(values, returns, is_series):
+    result = pd.DataFrame(values, index=returns.index, columns=returns.columns)
+    return result.iloc[:, 0] if is_series else result
+
+
+def _rolling_sum(values, window):
+    """ Sums of the trailing windows of each column from one cumulative sum (NaN before the first full window) """
+    cumulative = np.vstack([np.zeros(values.shape[1]), np.cumsum(values, axis=0)])
+    sums = np.full(values.shape, np.nan)
+    sums[window - 1:] = cumulative[window:] - cumulative[:-window]
+    return sums
+
+
+def _rolling_moments(returns, window):
+    """ Running sums of the returns of each column, taken around the column mean to avoid loss of precision
+
+    :return: mean and sample standard deviation of each trailing window (NaN unless the window is complete)
+    """
+    values = np.asarray(returns.values, dtype=np.float64)
+    valid = ~np.isnan(values)
+    shift = np.nanmean(values, axis=0)
+    centered = np.where(valid, values - shift, 0)
+    count = _rolling_sum(valid.astype(np.float64), window)
+    total = _rolling_sum(centered, window)
+    squares = _rolling_sum(centered ** 2, window)
+    complete = count == window
+    mean = np.where(complete, total / window + shift, np.nan)
+    variance = np.where(complete, (squares - total ** 2 / window) / (window - 1), np.nan)
+
+    return mean, np.sqrt(np.maximum(variance, 0))
+
+
+def _rolling_max(values, window):
+    """ Maximum of the trailing windows of each column (of the values so far for the first window - 1 rows).
+
+    Van Herk / Gil-Werman: within blocks of window rows the running maxima from the left and from the right are
+    taken, and the maximum of any window is the maximum of the right running max at its start and the left running
+    max at its end, 3 comparisons per value whatever the window length.
+    """
+    n_rows, n_columns = values.shape
+    if window >= n_rows:
+        return np.maximum.accumulate(values, axis=0)
+    n_blocks = -(-n_rows // window)
+    padded = np.full((n_blocks * window, n_columns), -np.inf)
+    padded[:n_rows] = values
+    blocks = padded.reshape(n_blocks, window, n_columns)
+    from_left = np.maximum.accumulate(blocks, axis=1).reshape(-1, n_columns)
+    from_right = np.maximum.accumulate(blocks[:, ::-1], axis=1)[:, ::-1].reshape(-1, n_columns)
+
+    maxima = np.empty(values.shape)
+    maxima[:window - 1] = np.maximum.accumulate(values[:window - 1], axis=0)
+    maxima[window - 1:] = np.maximum(from_right[:n_rows - window + 1], from_left[window - 1:n_rows])
+    return maxima
+
+
+def rolling_volatility(returns, window=126, annualization=252):
+    """ Rolling annualized volatility, same as returns.rolling(window).std() * sqrt(annualization)
+
+    :param returns: Series or DataFrame of daily returns (one column per portfolio)
+    :param window: number of returns of each window
+    :param annualization: number of return periods in a year
+    :return: Series or DataFrame of rolling volatilities
+    """
+    frame, is_series = _as_frame(returns)
+    std = _rolling_moments(frame, window)[1]
+    return _as_input(std * np.sqrt(annualization), frame, is_series)
+
+
+def rolling_sharpe_ratio(returns, window=126, risk_free=0, annualization=252):
+    """ Rolling annualized Sharpe ratio
+
+    :param returns: Series or DataFrame of daily returns (one column per portfolio)
+    :param window: number of returns of each window
+    :param risk_free: daily risk free rate
+    :param annualization: number of return periods in a year
+    :return: Series or DataFrame of rolling Sharpe ratios
+    """
+    frame, is_series = _as_frame(returns)
+    mean, std = _rolling_moments(frame, window)
+    return _as_input((mean - risk_free) / std * np.sqrt(annualization), frame, is_series)
+
+
+def rolling_beta(returns, benchmark_returns=None, window=126):
+    """ Rolling beta to a benchmark, over the windows where both returns are known
+
+    :param returns: Series or DataFrame of daily returns (one column per portfolio)
+    :param benchmark_returns: daily returns of the benchmark (Series or one column DataFrame), S&P 500 if None
+    :param window: number of returns of each window
+    :return: Series or DataFrame of rolling betas
+    """
+    frame, is_series = _as_frame(returns)
+    if benchmark_returns is None:
+        benchmark_returns = sdata.get_sp500_index_returns(frame.index.min(), frame.index.max())
+    if isinstance(benchmark_returns, pd.DataFrame):
+        benchmark_returns = benchmark_returns.iloc[:, 0]
+
+    values = np.asarray(frame.values, dtype=np.float64)
+    benchmark = benchmark_returns.reindex(frame.index).values.astype(np.float64)[:, None]
+    both = ~np.isnan(values) & ~np.isnan(benchmark)
+    y = np.where(both, values - np.nanmean(values, axis=0), 0)
+    x = np.where(both, benchmark - np.nanmean(benchmark), 0)
+    count = _rolling_sum(both.astype(np.float64), window)
+    sum_x = _rolling_sum(x, window)
+    covariance = _rolling_sum(x * y, window) - sum_x * _rolling_sum(y, window) / window
+    variance = _rolling_sum(x ** 2, window) - sum_x ** 2 / window
+    beta = np.where(count == window, covariance / np.where(variance > 0, variance, np.nan), np.nan)
+
+    return _as_input(beta, frame, is_series)
+
+
+def rolling_value_at_risk(returns, window=126, probability=0.05, method='historical'):
+    """ Rolling daily Value at Risk
+
+    :param returns: Series or DataFrame of daily returns (one column per portfolio)
+    :param window: number of returns of each window
+    :param probability: probability of the Value at Risk
+    :param method: 'historical' (quantile of the window with linear interpolation, as value_at_risk) or
+        'gaussian' (mean + z std of the window, from the running sums)
+    :return: Series or DataFrame of rolling Value at Risk
+    """
+    frame, is_series = _as_frame(returns)
+    if method == 'historical':
+        value_ar = frame.rolling(window).quantile(probability, interpolation='linear').values
+    elif method == 'gaussian':
+        mean, std = _rolling_moments(frame, window)
+        value_ar = mean + stats.norm.ppf(probability) * std
+    else:
+        raise ValueError("method must be 'historical' or 'gaussian'")
+
+    return _as_input(value_ar, frame, is_series)
+
+
+def rolling_drawdown(returns, window=None):
+    """ Drawdown of the cumulative returns from their highest value over the trailing window
+
+    :param returns: Series or DataFrame of daily returns (one column per portfolio)
+    :param window: number of days of the trailing window, None for the highest value since the start (underwater)
+    :return: Series or DataFrame of drawdowns (0 or negative)
+    """
+    frame, is_series = _as_frame(returns)
+    wealth = np.cumprod(1 + np.nan_to_num(np.asarray(frame.values, dtype=np.float64)), axis=0)
+    peak = np.maximum.accumulate(wealth, axis=0) if window is None else _rolling_max(wealth, window)
+
+    return _as_input(wealth / peak - 1, frame, is_series)
+
+
+def rolling_measures(returns, window=126, benchmark_returns=None, probability=0.05, annualization=252):
+    """ Rolling measures of many portfolios, the running sums being shared by the volatility and Sharpe ratio
+
+    :param returns: DataFrame of daily returns, one column per portfolio
+    :param window: number of returns of each window
+    :param benchmark_returns: daily returns of the benchmark, S&P 500 if None
+    :param probability: probability of the Value at Risk
+    :param annualization: number of return periods in a year
+    :return: dict of measure name to DataFrame (dates x portfolios)
+    """
+    mean, std = _rolling_moments(returns, window)
+    return {'Volatility': _as_input(std * np.sqrt(annualization), returns, False),
+            'Sharpe Ratio': _as_input(mean / std * np.sqrt(annualization), returns, False),
+            'Beta': rolling_beta(returns, benchmark_returns, window),
+            'Value at Risk': rolling_value_at_risk(returns, window, probability),
+            'Drawdown': rolling_drawdown(returns, window)}
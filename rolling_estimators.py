@@ -0,0 +1,172 @@
+# estimators updated incrementally over the overlapping windows of consecutive rebalancing dates
+
+import numpy as np
+from scipy.linalg import cho_factor, cho_solve
+
+
+class RollingWindow:
+    """ Bookkeeping of a rolling window of dated rows: finds which rows of the current window leave and which rows
+    of a new window enter, so estimators can update running sums instead of recomputing them
+    """
+
+    def __init__(self, refresh_period=None):
+        """
+        :param refresh_period: number of incremental updates after which the sums are recomputed from scratch
+            (None to never refresh)
+        """
+        self.refresh_period = refresh_period
+        self.reset()
+
+    def reset(self):
+        """ Forgets the current window """
+        self.index = None
+        self.columns = None
+        self._n_updates = 0
+
+    def _overlap(self, index, columns):
+        """ Number of leading rows of the new window already held at the end of the current one """
+        if self.index is None or columns != self.columns or len(index) == 0:
+            return 0
+        n_drop = self.index.searchsorted(index[0])
+        overlap = len(self.index) - n_drop
+        if overlap <= 0 or overlap > len(index) or not index[:overlap].equals(self.index[n_drop:]):
+            return 0
+        return overlap
+
+    def _move(self, index, columns):
+        """ Moves the window to the new rows
+
+        :param index: dates of the new window
+        :param columns: labels of the new window's columns
+        :return: number of rows to remove from the start of the current window and number of rows of the new window
+            already held, or None when the sums should be rebuilt from scratch
+        """
+        overlap = self._overlap(index, columns)
+        n_drop = 0 if self.index is None else len(self.index) - overlap
+        refresh = self.refresh_period is not None and self._n_updates >= self.refresh_period
+        self.index = index
+        self.columns = columns
+        if overlap == 0 or refresh or n_drop + len(index) - overlap >= len(index):
+            self._n_updates = 0
+            return None
+        self._n_updates += 1
+        return n_drop, overlap
+
+
+class RollingCovariance(RollingWindow):
+    """ Sample covariance of a rolling returns window, kept as running sums.
+
+    Consecutive rebalancing windows share most of their days, so instead of recomputing the covariance from
+    scratch the days leaving the window are removed and the new days added as rank-k updates of the running sums,
+    costing O(days changed * n^2) per window instead of O(window days * n^2).
+    Sums are taken around a fixed shift (the column means of the first window) to avoid loss of precision.
+    """
+
+    def reset(self):
+        """ Forgets the current window """
+        super().reset()
+        self._values = None
+        self._shift = None
+        self._sum = None
+        self._cross = None
+
+    def update(self, returns):
+        """ Moves the window to the given returns and gives their sample covariance
+
+        :param returns: DataFrame of stock returns of the new window (dates as index)
+        :return: Covariance matrix, same as returns.cov().values
+        """
+        values = np.asarray(returns.values, dtype=np.float64)
+        if np.isnan(values).any():
+            # pairwise deletion of missing values can not be updated incrementally
+            self.reset()
+            return returns.cov().values
+
+        move = self._move(returns.index, list(returns.columns))
+        if move is None:
+            self._shift = values.mean(axis=0)
+            centered = values - self._shift
+            self._sum = centered.sum(axis=0)
+            self._cross = np.matmul(centered.T, centered)
+        else:
+            n_drop, overlap = move
+            removed = self._values[:n_drop] - self._shift
+            added = values[overlap:] - self._shift
+            self._sum += added.sum(axis=0) - removed.sum(axis=0)
+            self._cross += np.matmul(added.T, added) - np.matmul(removed.T, removed)
+        self._values = values
+
+        return self.covariance()
+
+    def covariance(self):
+        """ Sample covariance (ddof=1) of the current window
+
+        :return: Covariance matrix
+        """
+        n_days = self._values.shape[0]
+        return (self._cross - np.outer(self._sum, self._sum) / n_days) / (n_days - 1)
+
+
+class RollingLoadings(RollingWindow):
+    """ Least squares loadings of all stocks on the factors over a rolling window.
+
+    The factor Gram matrix F'F (k x k) and the cross products F'Y (k x n) are updated with the days entering and
+    leaving the window, and all stocks are solved at once with a single Cholesky factorisation of F'F.
+    The normal equations square the condition number of the factors, so when F'F is ill conditioned (nearly
+    collinear factors) the window is solved by least squares on the returns instead, as statsmodels does.
+    """
+
+    def __init__(self, refresh_period=None, max_condition=1e6):
+        """
+        :param refresh_period: number of incremental updates after which the sums are recomputed from scratch
+            (None to never refresh)
+        :param max_condition: largest condition number of F'F solved through the normal equations (relative error
+            about max_condition * 1e-16); above it the window is solved by least squares
+        """
+        self.max_condition = max_condition
+        super().__init__(refresh_period)
+
+    def reset(self):
+        """ Forgets the current window """
+        super().reset()
+        self._stocks = None
+        self._factors = None
+        self._gram = None
+        self._cross = None
+
+    def update(self, stocks, factors):
+        """ Moves the window to the given returns and gives the loadings of the stocks on the factors
+
+        :param stocks: DataFrame of stock returns of the new window (dates as index)
+        :param factors: DataFrame of factor returns over the same dates
+        :return: Matrix (factors x stocks) of loadings
+        """
+        Y = np.asarray(stocks.values, dtype=np.float64)
+        X = np.asarray(factors.values, dtype=np.float64)
+        if np.isnan(Y).any() or np.isnan(X).any():
+            self.reset()
+            return np.matmul(np.linalg.pinv(X), Y)
+
+        move = self._move(stocks.index, (list(stocks.columns), list(factors.columns)))
+        if move is None:
+            self._gram = np.matmul(X.T, X)
+            self._cross = np.matmul(X.T, Y)
+        else:
+            n_drop, overlap = move
+            X_removed, Y_removed = self._factors[:n_drop], self._stocks[:n_drop]
+            X_added, Y_added = X[overlap:], Y[overlap:]
+            self._gram += np.matmul(X_added.T, X_added) - np.matmul(X_removed.T, X_removed)
+            self._cross += np.matmul(X_added.T, Y_added) - np.matmul(X_removed.T, Y_removed)
+        self._stocks = Y
+        self._factors = X
+
+        if np.linalg.cond(self._gram) > self.max_condition:
+            # nearly collinear factors: SVD least squares on the window (minimum norm solution as statsmodels gives
+            # for collinear factors), the running sums are kept for the next windows
+            return np.linalg.lstsq(X, Y, rcond=None)[0]
+        try:
+            return cho_solve(cho_factor(self._gram), self._cross)
+        except np.linalg.LinAlgError:
+            # collinear factors: minimum norm solution as statsmodels would give
+            self.reset()
+            return np.matmul(np.linalg.pinv(X), Y)
@@ -1,8 +1,13 @@
+import os
 from pandas_datareader import data as pdr
 import yfinance as yf
 import pandas as pd
+import numpy as np
+import data_cache
 yf.pdr_override()
 
+PRICES_FILE = r'Data\Equities\SP500.csv'
+
 
 def get_prices_yf(tickers, start_date, end_date):
     prices = pd.DataFrame([pdr.get_data_yahoo(t, start_date, end_date).loc[:, 'Adj Close'] for t in tickers],
@@ -10,10 +15,135 @@ def get_prices_yf(tickers, start_date, end_date):
     return prices
 
 
+class PriceStore:
+    """ Equity prices held in memory as a dense date x ticker matrix
+
+    The universe file is parsed once and kept as a float matrix with a sorted date index and a ticker to column
+    map, so that price windows are obtained by slicing instead of re-reading the file.
+    """
+
+    def __init__(self, dates, tickers, values, index_name=None, return_dates=None, returns=None, source_hash=None):
+        """
+        :param dates: sorted array of price dates (datetime64)
+        :param tickers: list of tickers, one per column of values
+        :param values: 2-D array of prices with shape (len(dates), len(tickers))
+        :param index_name: name given to the date index of the returned DataFrames
+        :param return_dates: business days of the returns panel
+        :param returns: 2-D array of daily returns over the business days (forward filled prices)
+        :param source_hash: content hash of the source file, identifies the data (see risk_model_cache)
+        """
+        self.dates = np.asarray(dates, dtype='datetime64[ns]')
+        self.tickers = list(tickers)
+        self.columns = {t: i for i, t in enumerate(self.tickers)}
+        self.values = values
+        self.index_name = index_name
+        self.return_dates = None if return_dates is None else np.asarray(return_dates, dtype='datetime64[ns]')
+        self.returns = returns
+        self.source_hash = source_hash
+
+    @classmethod
+    def from_cache(cls, file_path):
+        """ Builds the store from the compiled (memory mapped) form of a prices csv file.
+        The compiled form is rebuilt when the csv file changes.
+
+        :param file_path: path of the csv file
+        :return: PriceStore
+        """
+        index, panels = data_cache.compiled_panels(file_path, _build_price_panels, ['prices', 'returns'])
+        return cls(index['dates'], index['tickers'].tolist(), panels['prices'], str(index['index_name']) or None,
+                   index['return_dates'], panels['returns'], str(index['source_hash']))
+
+    def rows(self, start_date=None, end_date=None):
+        """ Row slice of the dates between 2 dates (both included)
+
+        :param start_date: first date, None for the beginning of the data
+        :param end_date: last date, None for the end of the data
+        :return: slice over the rows of values
+        """
+        first = 0 if start_date is None else np.searchsorted(self.dates, _to_datetime64(start_date), side='left')
+        last = len(self.dates) if end_date is None else np.searchsorted(self.dates, _to_datetime64(end_date),
+                                                                          side='right')
+        return slice(first, last)
+
+    def column_indices(self, tickers):
+        """ Column positions of the tickers
+
+        :param tickers: list of tickers
+        :return: list of column positions
+        """
+        return [self.columns[t] for t in tickers]
+
+    def window(self, tickers, start_date, end_date):
+        """ Raw prices of tickers between 2 dates
+
+        :param tickers: list of tickers
+        :param start_date: first date (included)
+        :param end_date: last date (included)
+        :return: 2-D array of prices and the respective dates
+        """
+        rows = self.rows(start_date, end_date)
+        cols = self.column_indices(tickers)
+        if cols and cols == list(range(cols[0], cols[0] + len(cols))):
+            values = self.values[rows, cols[0]:cols[0] + len(cols)]
+        else:
+            values = self.values[rows][:, cols]
+        return values, self.dates[rows]
+
+    def prices(self, tickers, start_date, end_date):
+        """ Prices of tickers between 2 dates, forward filled inside the window
+
+        :param tickers: list of tickers
+        :param start_date: first date (included)
+        :param end_date: last date (included)
+        :return: DataFrame of prices
+        """
+        values, dates = self.window(tickers, start_date, end_date)
+        prices = pd.DataFrame(values, index=pd.DatetimeIndex(dates, name=self.index_name),
+                              columns=list(tickers)).ffill()
+        return prices
+
+
+_price_stores = {}
+
+
+def _to_datetime64(date):
+    return np.datetime64(pd.Timestamp(date), 'ns')
+
+
+def _build_price_panels(file_path):
+    """ Parses a prices csv file into the panels stored in its compiled form
+
+    :param file_path: path of the csv file
+    :return: dict of index arrays and dict of price and returns panels
+    """
+    data = pd.read_csv(file_path, parse_dates=True, index_col=0).sort_index()
+    business_day_prices = data.ffill().asfreq('B').ffill()
+    returns = np.full(business_day_prices.shape, np.nan)
+    returns[1:] = business_day_prices.values[1:] / business_day_prices.values[:-1] - 1
+    index = {'dates': data.index.values.astype('datetime64[ns]'),
+             'return_dates': business_day_prices.index.values.astype('datetime64[ns]'),
+             'tickers': np.array(data.columns, dtype=str),
+             'index_name': np.array(data.index.name or '')}
+
+    return index, {'prices': data.values.astype(np.float64), 'returns': returns}
+
+
+def get_price_store(file_path=PRICES_FILE):
+    """ Process wide price store, memory mapped from the compiled form of the file.
+    The store is built again when the modification time of the file changes, as the compiled form is.
+
+    :param file_path: path of the prices csv file
+    :return: PriceStore
+    """
+    mtime = os.path.getmtime(file_path)
+    if file_path not in _price_stores or _price_stores[file_path][0] != mtime:
+        _price_stores[file_path] = (mtime, PriceStore.from_cache(file_path))
+
+    return _price_stores[file_path][1]
+
+
 def get_prices_file(tickers, start_date, end_date):
-    data = pd.read_csv('Data\Equities\SP500.csv', parse_dates=True, index_col=0)
-    prices = pd.DataFrame([data.loc[start_date:end_date, t] for t in tickers]
-                          ).T.ffill()
+    prices = get_price_store().prices(tickers, start_date, end_date)
 
     return prices
 
@@ -30,8 +160,18 @@ def get_daily_returns(tickers, start_date, end_date):
     return returns
 
 
-def get_covariance_matrix(prices):
-    covariance_matrix = prices.shape[0] * prices.asfreq('B').pct_change().iloc[1:, :].cov().values
+def get_covariance_matrix(prices, rolling_covariance=None):
+    """ Covariance matrix of the daily returns of prices, scaled by the number of price observations
+
+    :param prices: DataFrame of prices
+    :param rolling_covariance: optional rolling_estimators.RollingCovariance reused across consecutive windows
+    :return: covariance matrix
+    """
+    returns = prices.asfreq('B').pct_change().iloc[1:, :]
+    if rolling_covariance is None:
+        covariance_matrix = prices.shape[0] * returns.cov().values
+    else:
+        covariance_matrix = prices.shape[0] * rolling_covariance.update(returns)
 
     return covariance_matrix
 
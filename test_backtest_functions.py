@@ -0,0 +1,78 @@
+# checks of the back test engine against an explicit day by day loop
+# run with: python -m pytest test_backtest_functions.py
+
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('pandas_datareader')
+pytest.importorskip('yfinance')
+
+import stock_data
+import backtest_functions as bf
+
+HOLIDAYS = pd.DatetimeIndex(['2019-06-28', '2019-07-04'])
+# trading day after a rebalancing where A and B move in opposite directions: a zero return of the A/B portfolio
+OFFSETTING_DAY = pd.Timestamp('2019-03-01')
+
+
+@pytest.fixture
+def price_store(monkeypatch):
+    """ Random returns of 6 stocks over 2019, none on the holidays """
+    rng = np.random.default_rng(0)
+    days = pd.bdate_range('2019-01-01', '2019-12-31')
+    returns = 0.01 * rng.standard_normal((len(days), 6))
+    returns[days.isin(HOLIDAYS)] = 0
+    returns[days == OFFSETTING_DAY] = [0.01, -0.01, 0, 0, 0, 0]
+    returns[0] = np.nan
+    prices = 100 * np.cumprod(1 + np.nan_to_num(returns), axis=0)
+    store = stock_data.PriceStore(days.values, list('ABCDEF'), prices, 'Date', days.values, returns)
+    monkeypatch.setattr(stock_data, 'get_price_store', lambda file_path=stock_data.PRICES_FILE: store)
+
+    return store
+
+
+def _weights(seed, tickers=list('ABCDEF')):
+    rng = np.random.default_rng(seed)
+    rebalance_dates = pd.date_range('2019-01-01', '2019-12-31', freq='BME')
+    return pd.DataFrame(rng.uniform(-0.2, 0.5, (len(rebalance_dates), len(tickers))), index=rebalance_dates,
+                        columns=tickers)
+
+
+def _loop_returns(store, weights, drift):
+    """ Daily returns of the portfolio computed one day at a time, without the holidays """
+    returns = pd.DataFrame(np.nan_to_num(store.returns), index=pd.DatetimeIndex(store.return_dates),
+                           columns=store.tickers)
+    returns = returns.loc[weights.index[0]:weights.index[-1], list(weights.columns)].iloc[1:]
+    k = 0
+    held = weights.values[0].copy()
+    daily_returns = {}
+    for day, r in returns.iterrows():
+        portfolio_return = np.dot(held, r.values)
+        if (r.values[weights.values[k] != 0] != 0).any():
+            daily_returns[day] = portfolio_return
+        if drift:
+            held = held * (1 + r.values) / (1 + portfolio_return)
+        if day in weights.index:
+            k = weights.index.get_loc(day)
+            held = weights.values[k].copy()
+
+    return pd.Series(daily_returns, name='Returns')
+
+
+@pytest.mark.parametrize('drift', [False, True])
+def test_back_tests_match_day_by_day_loop(price_store, drift):
+    weights = {'p': _weights(1), 'q': _weights(2), 'ab': _weights(3) * 0}
+    weights['ab'][['A', 'B']] = 0.5
+
+    batched = bf.portfolios_daily_returns(weights, drift)
+
+    for name in weights:
+        expected = _loop_returns(price_store, weights[name], drift)
+        assert not expected.index.isin(HOLIDAYS).any() and OFFSETTING_DAY in expected.index
+        assert batched.index.equals(expected.index)
+        np.testing.assert_allclose(batched[name].values, expected.values, rtol=0, atol=1e-14)
+    for name in weights:
+        single = bf.daily_returns_of_portfolio(weights[name], drift)
+        assert single.index.equals(batched.index)
+        np.testing.assert_allclose(single.values, batched[name].values, rtol=0, atol=1e-14)
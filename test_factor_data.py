@@ -0,0 +1,43 @@
+# checks of the in-memory factor store
+# run with: python -m pytest test_factor_data.py
+
+import numpy as np
+import pytest
+
+from factor_data import FactorStore
+
+
+def _factor_store():
+    rng = np.random.default_rng(0)
+    values = 0.01 * rng.standard_normal((100, 3))
+    values[10, 1] = np.nan
+    return FactorStore(np.arange(100).astype('datetime64[D]'), ['A', 'B', 'C'], values)
+
+
+def test_composites_are_weighted_sums_of_base_factors():
+    factor_store = _factor_store()
+    factor_store.add_composites({'AB': {'A': 0.5, 'B': 0.5}, 'BC': {'B': 0.25, 'C': 0.75}})
+
+    expected = np.column_stack([0.5 * factor_store.values[:, 0] + 0.5 * factor_store.values[:, 1],
+                                0.25 * factor_store.values[:, 1] + 0.75 * factor_store.values[:, 2]])
+    np.testing.assert_allclose(factor_store.window(['AB', 'BC'], None, None).values, expected, rtol=0, atol=1e-15)
+
+
+def test_redefined_composite_is_computed_again():
+    factor_store = _factor_store()
+    factor_store.add_composites({'AB': {'A': 0.5, 'B': 0.5}, 'BC': {'B': 0.25, 'C': 0.75}})
+    bc = factor_store.window(['BC'], None, None).values
+
+    factor_store.add_composites({'AB': {'A': 1.0}})
+
+    assert factor_store.factors == ['A', 'B', 'C', 'AB', 'BC']
+    assert factor_store.composites['AB'] == {'A': 1.0}
+    np.testing.assert_array_equal(factor_store.window(['AB'], None, None).values[:, 0], factor_store.values[:, 0])
+    np.testing.assert_array_equal(factor_store.window(['BC'], None, None).values, bc)
+
+
+def test_base_factor_can_not_be_redefined():
+    factor_store = _factor_store()
+
+    with pytest.raises(ValueError):
+        factor_store.add_composites({'A': {'B': 1.0}})
@@ -0,0 +1,96 @@
+# checks of the factor risk parity solver against the SLSQP problems it replaces
+# run with: python -m pytest test_factor_risk_parity.py
+
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('pandas_datareader')
+pytest.importorskip('yfinance')
+pytest.importorskip('alive_progress')
+
+import factor_risk_parity as frp
+
+
+def _factor_returns(seed, n_stocks=50, n_factors=4, n_days=252):
+    """ Stock and factor returns of a random linear factor model """
+    rng = np.random.default_rng(seed)
+    factors = rng.normal(0, 0.01, (n_days, n_factors))
+    loadings = rng.normal(0.5, 0.5, (n_stocks, n_factors))
+    stocks = np.matmul(factors, loadings.T) + rng.normal(0, 0.01, (n_days, n_stocks))
+
+    return pd.DataFrame(stocks), pd.DataFrame(factors, columns=['F{}'.format(i) for i in range(n_factors)])
+
+
+def _risk_parity_objective(risk_model, clusters, x):
+    """ Objective of the SLSQP factor risk parity problems (sum of the squared risk parity residuals) """
+    risk_contributions = risk_model.risk_contributions(x)
+    if clusters is None:
+        return np.sum((risk_contributions / risk_model.volatility(x) - 1 / len(risk_contributions)) ** 2)
+    shares = np.matmul(clusters, risk_contributions) / risk_contributions.sum()
+    return np.sum((shares - 1 / clusters.shape[0]) ** 2)
+
+
+@pytest.mark.parametrize('seed', range(3))
+@pytest.mark.parametrize('factor_structure', [[1, 1, 1, 1], [1, 1, 2]])
+def test_solve_factor_risk_parity_matches_slsqp(seed, factor_structure):
+    stocks, factors = _factor_returns(seed)
+    loadings_matrix = frp.get_loading_matrix(stocks, factors)
+    sigma = frp.big_sigma(stocks)
+    risk_model = frp.FactorRiskModel(loadings_matrix, sigma)
+    clusters = None if len(factor_structure) == factors.shape[1] else frp.cluster_matrix(factor_structure)
+    x0 = np.ones(stocks.shape[1]) / stocks.shape[1]
+
+    x, info = frp.solve_factor_risk_parity(risk_model, x0, clusters)
+    if clusters is None:
+        x_slsqp = frp.weights_factor_risk_parity(stocks, factor_structure, loadings_matrix, sigma, None, risk_model)
+    else:
+        x_slsqp = frp.weights_factor_risk_parity_shared_rc(stocks, factor_structure, loadings_matrix, sigma, None,
+                                                            risk_model)
+
+    assert info['converged'] and info['feasible'] and not info['stalled']
+    assert x.sum() == pytest.approx(1, abs=1e-12)
+    # same problem as SLSQP, solved to a tighter tolerance
+    assert _risk_parity_objective(risk_model, clusters, x) <= 1e-12
+    assert _risk_parity_objective(risk_model, clusters, x) <= _risk_parity_objective(risk_model, clusters, x_slsqp)
+
+
+def test_solve_factor_risk_parity_not_converged_within_max_iter():
+    stocks, factors = _factor_returns(0)
+    risk_model = frp.FactorRiskModel(frp.get_loading_matrix(stocks, factors), frp.big_sigma(stocks))
+    x0 = np.ones(stocks.shape[1]) / stocks.shape[1]
+
+    x, info = frp.solve_factor_risk_parity(risk_model, x0, max_iter=1)
+
+    assert not info['converged']
+
+
+class _ConstantRiskModel:
+    """ Risk model whose risk contributions do not depend on the weights, so every point is stationary with
+    residuals away from parity
+    """
+
+    def __init__(self, risk_contributions, n_stocks):
+        self.rc = np.asarray(risk_contributions, dtype=np.float64)
+        self.A = np.full((n_stocks, len(self.rc)), 1 / n_stocks)
+
+    def risk_contributions(self, x):
+        return self.rc
+
+    def risk_contributions_jacobian(self, x):
+        return np.zeros((len(self.rc), len(x)))
+
+    def volatility(self, x):
+        return self.rc.sum()
+
+    def covariance_times(self, x):
+        return np.zeros(len(x))
+
+
+def test_solve_factor_risk_parity_local_minimum_is_stalled():
+    risk_model = _ConstantRiskModel([0.1, 0.2, 0.7], 10)
+
+    x, info = frp.solve_factor_risk_parity(risk_model, np.ones(10) / 10)
+
+    assert info['fun'] > 1e-12
+    assert info['stalled'] and not info['converged']
@@ -0,0 +1,30 @@
+# checks of the vectorised factor screening statistics against scipy
+# run with: python -m pytest test_factor_screening.py
+
+import numpy as np
+import pandas as pd
+import pytest
+from scipy.stats import pearsonr
+
+import factor_screening as fs
+
+
+@pytest.mark.parametrize('pairwise', [False, True])
+def test_correlation_tests_matches_pearsonr(pairwise):
+    rng = np.random.default_rng(4)
+    factor_returns = pd.DataFrame(np.matmul(rng.normal(size=(1000, 6)), rng.normal(size=(6, 6))) * 0.01,
+                                  columns=list('abcdef'))
+    factor_returns.iloc[:50, 2] = np.nan
+    factor_returns.iloc[100:120, 4] = np.nan
+
+    corr, t_stats, p_values, n_obs = fs.correlation_tests(factor_returns, pairwise)
+
+    for a in factor_returns:
+        for b in factor_returns:
+            if a == b:
+                continue
+            pair = factor_returns[[a, b]].dropna() if pairwise else factor_returns.dropna()
+            reference = pearsonr(pair[a], pair[b])
+            assert corr.loc[a, b] == pytest.approx(reference[0], abs=1e-14)
+            assert p_values.loc[a, b] == pytest.approx(reference[1], rel=1e-10, abs=1e-14)
+            assert n_obs.loc[a, b] == len(pair)
@@ -0,0 +1,47 @@
+# checks of the factor weight parity solver against the SLSQP problem it replaces
+# run with: python -m pytest test_factor_weight_parity.py
+
+import numpy as np
+import pandas as pd
+import pytest
+from scipy.optimize import minimize
+
+pytest.importorskip('pandas_datareader')
+pytest.importorskip('yfinance')
+pytest.importorskip('alive_progress')
+
+import factor_risk_parity as frp
+import factor_weight_parity as fwp
+
+
+def _factor_returns(seed, n_stocks=50, n_factors=4, n_days=252):
+    """ Stock and factor returns of a random linear factor model """
+    rng = np.random.default_rng(seed)
+    factors = rng.normal(0, 0.01, (n_days, n_factors))
+    loadings = rng.normal(0.5, 0.5, (n_stocks, n_factors))
+    stocks = np.matmul(factors, loadings.T) + rng.normal(0, 0.01, (n_days, n_stocks))
+
+    return pd.DataFrame(stocks), pd.DataFrame(factors, columns=['F{}'.format(i) for i in range(n_factors)])
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_solve_factor_weight_parity_matches_slsqp(seed):
+    stocks, factors = _factor_returns(seed)
+    loadings_matrix = frp.get_loading_matrix(stocks, factors)
+    AT = loadings_matrix.values.T
+    n_stocks = stocks.shape[1]
+    target = 1 / AT.shape[0]
+    x0 = np.ones(n_stocks) / n_stocks
+
+    x, info = fwp.solve_factor_weight_parity(loadings_matrix, x0)
+    x_slsqp = fwp.weights_factor_weight_parity(stocks, [1] * AT.shape[0], loadings_matrix, None)
+    # the portfolio closest to x0 with the target exposures, by SLSQP with a tight tolerance
+    reference = minimize(lambda z: 0.5 * np.sum((z - x0) ** 2), x0, jac=lambda z: z - x0, method='SLSQP',
+                         bounds=[(-1 / n_stocks, 1)] * n_stocks,
+                         constraints=[{'type': 'eq', 'fun': lambda z: np.r_[np.matmul(AT, z) - target, z.sum() - 1]}],
+                         tol=1e-14, options={'maxiter': 500})
+
+    assert info['converged']
+    assert np.abs(np.matmul(AT, x) - target).max() <= 1e-10
+    assert np.sum((np.matmul(AT, x) - target) ** 2) <= np.sum((np.matmul(AT, x_slsqp) - target) ** 2) + 1e-12
+    assert np.abs(x - reference.x).max() <= 1e-8
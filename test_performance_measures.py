@@ -0,0 +1,50 @@
+# checks of the vectorised metrics engine against the empyrical measures it replaces
+# run with: python -m pytest test_performance_measures.py
+
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('empyrical')
+pytest.importorskip('pandas_datareader')
+pytest.importorskip('yfinance')
+pytest.importorskip('alive_progress')
+
+import performance_measures as pm
+
+
+def _measures_one_at_a_time(portfolio_daily_returns, benchmark_returns, var_probability):
+    """ Measures of one portfolio computed by the single measure functions (empyrical calls) """
+    s = portfolio_daily_returns
+    return pd.Series({'Annualized Returns (CAGR) (%)': pm.annual_returns_cagr(s) * 100,
+                      'Cumulative Returns (%)': pm.cumulative_returns(s) * 100,
+                      'Annualized Volatility (%)': pm.annual_volatility(s) * 100,
+                      'Sharpe Ratio': pm.sharpe_ratio(s),
+                      'Max Drawdown (%)': pm.max_drawdown(s) * 100,
+                      'Calmar Ratio': pm.calmar_ratio(s),
+                      'Stability': pm.stability(s),
+                      'Skewness': pm.skewness(s),
+                      'Kurtosis': pm.kurtosis(s),
+                      'Daily Value at Risk (VaR) (%)': pm.value_at_risk(s, var_probability) * 100,
+                      'Expected Shortfall (%)': pm.expected_shortfall(s, var_probability) * 100,
+                      'Tail Ratio': pm.tail_ratio(s, var_probability),
+                      'Alpha': pm.alpha(s, benchmark_returns),
+                      'Beta': pm.beta(s, benchmark_returns)})
+
+
+@pytest.mark.parametrize('var_probability', [0.05, 0.01])
+def test_performance_measures_table_matches_empyrical(var_probability):
+    rng = np.random.default_rng(1)
+    days = pd.bdate_range('2005-01-03', periods=2500)
+    returns = pd.DataFrame(rng.normal(0.0004, 0.011, (len(days), 4)), index=days, columns=list('abcd'))
+    # shorter history
+    returns.iloc[:300, 2] = np.nan
+    benchmark = pd.DataFrame({'SP_500': rng.normal(0.0003, 0.01, 2600)},
+                             index=pd.bdate_range('2004-12-01', periods=2600))
+
+    table = pm.performance_measures_table(returns, benchmark, var_probability)
+
+    for column in returns:
+        expected = _measures_one_at_a_time(returns[column].dropna(), benchmark, var_probability)
+        pd.testing.assert_series_equal(table[column].loc[expected.index], expected, check_names=False,
+                                       rtol=1e-10, atol=1e-14)
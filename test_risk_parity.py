@@ -0,0 +1,27 @@
+# checks of the batched risk parity solver against riskparityportfolio
+# run with: python -m pytest test_risk_parity.py
+
+import numpy as np
+import pytest
+
+pytest.importorskip('pandas_datareader')
+pytest.importorskip('yfinance')
+pytest.importorskip('alive_progress')
+
+import risk_parity as rp
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_solve_risk_parity_matches_riskparityportfolio(seed):
+    rpp = pytest.importorskip('riskparityportfolio')
+    rng = np.random.default_rng(seed)
+    n_dates, n_assets = 4, 20
+    returns = rng.normal(0, 0.01, (n_dates, 250, n_assets)) + rng.normal(0, 0.01, (n_dates, 250, 1))
+    covariances = np.einsum('tki,tkj->tij', returns, returns) / 250
+
+    weights, convergence = rp.solve_risk_parity(covariances, tol=1e-14)
+    reference = np.array([rpp.vanilla.design(covariance, np.full(n_assets, 1 / n_assets), 1e-14, 1000)
+                          for covariance in covariances])
+
+    assert convergence['Converged'].all()
+    assert np.abs(weights - reference).max() < 1e-14
@@ -0,0 +1,57 @@
+# checks of the rolling estimators against the estimates they update incrementally
+# run with: python -m pytest test_rolling_estimators.py
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from rolling_estimators import RollingCovariance, RollingLoadings
+
+
+def _monthly_windows(values, days, lookback=252):
+    """ Overlapping windows of consecutive month ends, as the back tests use them """
+    for end in days[lookback::21]:
+        yield values.loc[end - pd.DateOffset(years=1):end]
+
+
+@pytest.mark.parametrize('refresh_period', [None, 3])
+def test_rolling_covariance_matches_sample_covariance(refresh_period):
+    rng = np.random.default_rng(0)
+    days = pd.bdate_range('2010-01-01', periods=1000)
+    returns = pd.DataFrame(0.01 * rng.standard_normal((len(days), 30)) + 0.002, index=days)
+    rolling_covariance = RollingCovariance(refresh_period)
+
+    for window in _monthly_windows(returns, days):
+        np.testing.assert_allclose(rolling_covariance.update(window), window.cov().values, rtol=1e-12, atol=1e-18)
+
+
+def test_rolling_covariance_with_missing_values():
+    rng = np.random.default_rng(1)
+    days = pd.bdate_range('2010-01-01', periods=600)
+    returns = pd.DataFrame(0.01 * rng.standard_normal((len(days), 10)), index=days)
+    returns.iloc[300:320, 3] = np.nan
+    rolling_covariance = RollingCovariance()
+
+    for window in _monthly_windows(returns, days):
+        np.testing.assert_allclose(rolling_covariance.update(window), window.cov().values, rtol=1e-12, atol=1e-18)
+
+
+@pytest.mark.parametrize('collinear', [False, True])
+def test_rolling_loadings_match_ols(collinear):
+    rng = np.random.default_rng(2)
+    days = pd.bdate_range('2010-01-01', periods=1000)
+    factors = 0.01 * rng.standard_normal((len(days), 4))
+    if collinear:
+        # nearly collinear factors, solved by least squares instead of the normal equations
+        factors[:, 3] = factors[:, 0] + 1e-6 * rng.standard_normal(len(days))
+    stocks = np.matmul(factors, rng.standard_normal((4, 20))) + 0.01 * rng.standard_normal((len(days), 20))
+    stocks = pd.DataFrame(stocks, index=days)
+    factors = pd.DataFrame(factors, index=days)
+    rolling_loadings = RollingLoadings()
+
+    for window in _monthly_windows(stocks, days):
+        window_factors = factors.loc[window.index]
+        # OLS parameters as statsmodels computes them (pinv of the factors)
+        expected = np.matmul(np.linalg.pinv(window_factors.values), window.values)
+        np.testing.assert_allclose(rolling_loadings.update(window, window_factors), expected,
+                                   rtol=1e-10, atol=1e-10 * np.abs(expected).max())